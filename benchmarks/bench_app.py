@@ -0,0 +1,51 @@
+"""
+main:app with MongoDB and S3 replaced by in-process fakes, for load tests.
+
+S3 is mocked with moto and MongoDB with mongomock-motor, so every uvicorn
+worker gets its own fakes. BENCH_USERS users (bench-<n>@example.com) are
+seeded so tokens signed with SECRET_KEY authenticate. Started by
+benchmarks/load_test.py:
+
+    uvicorn benchmarks.bench_app:app --workers 2
+"""
+import os
+from contextlib import asynccontextmanager
+
+import boto3
+from moto import mock_aws
+from mongomock_motor import AsyncMongoMockClient
+
+# S3 must be mocked before main creates its client and checks the bucket
+aws_mock = mock_aws()
+aws_mock.start()
+boto3.client("s3", region_name=os.getenv("S3_REGION", "us-east-1")).create_bucket(Bucket=os.environ["S3_BUCKET_NAME"])
+
+import main  # noqa: E402
+
+BENCH_USERS = int(os.getenv("BENCH_USERS", "50"))
+
+main.db_client = AsyncMongoMockClient()
+mongo = main.db_client["chatgpt_clone"]
+main.users_collection = mongo["users"]
+main.sessions_collection = mongo["sessions"]
+main.messages_collection = mongo["messages"]
+
+
+async def seed_users():
+    await main.users_collection.insert_many([
+        {"email": f"bench-{i}@example.com", "name": f"Bench User {i}", "picture": None}
+        for i in range(BENCH_USERS)
+    ])
+
+app_lifespan = main.app.router.lifespan_context
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # uvicorn imports this module inside its event loop, so seed on startup instead of at import
+    await seed_users()
+    async with app_lifespan(app):
+        yield
+
+main.app.router.lifespan_context = lifespan
+app = main.app
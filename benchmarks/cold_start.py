@@ -0,0 +1,142 @@
+"""
+Measure worker cold start: time from process start until it answers HTTP, and until /readyz passes.
+
+Starts `uvicorn main:app` several times and polls it. "serving" is the first HTTP
+response of any status from /healthz, so the same measurement works on commits
+that predate that endpoint. --slow-s3 points S3_ENDPOINT_URL at a local stand-in
+that takes that many seconds to answer, like a degraded S3 region, to show
+whether startup waits on it. To compare against an older commit, run the script
+on a checkout of it:
+
+    git worktree add /tmp/before <commit>
+    python benchmarks/cold_start.py --app-dir /tmp/before --slow-s3 5
+    python benchmarks/cold_start.py --slow-s3 5
+
+Without a local MongoDB, pass --required s3 so readiness doesn't wait on it.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_slow_s3(delay: float):
+    """An S3 stand-in that answers every request with an empty 200 after delay seconds"""
+    class Handler(BaseHTTPRequestHandler):
+        def answer(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_HEAD = do_GET = do_PUT = do_POST = answer
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(args, env):
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(args.workers)],
+        cwd=args.app_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    serving = ready = None
+    checks = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=args.ready_timeout) as client:
+            deadline = started + args.ready_timeout
+            while time.perf_counter() < deadline and ready is None:
+                try:
+                    if serving is None:
+                        client.get("/healthz")
+                        serving = time.perf_counter() - started
+                    response = client.get("/readyz")
+                    if response.status_code == 404:
+                        break
+                    checks = response.json().get("checks", {})
+                    if response.status_code == 200:
+                        ready = time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+                if process.poll() is not None:
+                    break
+                time.sleep(0.05)
+    finally:
+        process.terminate()
+        process.wait()
+    return serving, ready, checks
+
+
+def seconds(sample):
+    return "never" if sample is None else f"{sample:.2f}s"
+
+
+def describe(samples):
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return "never"
+    return f"median {statistics.median(samples):6.2f}s  min {min(samples):6.2f}s  max {max(samples):6.2f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default=ROOT, help="checkout whose main:app to start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--slow-s3", type=float, help="serve S3 from a local stand-in with this many seconds of latency")
+    parser.add_argument("--required", help="READY_REQUIRED for the app, e.g. 's3' when there is no local MongoDB")
+    parser.add_argument("--ready-timeout", type=float, default=30, help="give up on a run after this many seconds")
+    args = parser.parse_args()
+
+    env = {**os.environ, "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING")}
+    if args.required is not None:
+        env["READY_REQUIRED"] = args.required
+    if args.slow_s3 is not None:
+        s3 = start_slow_s3(args.slow_s3)
+        env.update(
+            S3_ENDPOINT_URL=f"http://127.0.0.1:{s3.server_address[1]}",
+            AWS_ACCESS_KEY="cold-start",
+            AWS_SECRET_KEY="cold-start"
+        )
+
+    serving, ready = [], []
+    for run in range(args.runs):
+        run_serving, run_ready, checks = measure(args, env)
+        serving.append(run_serving)
+        ready.append(run_ready)
+        failing = ", ".join(name for name, check in checks.items() if check.get("required") and not check.get("ok"))
+        print(
+            f"run {run + 1}: serving after {seconds(run_serving)}, ready after {seconds(run_ready)}"
+            + (f" (failing: {failing})" if run_ready is None and failing else "")
+        )
+    print(f"serving  {describe(serving)}")
+    print(f"ready    {describe(ready)}")
+
+
+if __name__ == "__main__":
+    main()
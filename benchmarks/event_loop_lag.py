@@ -0,0 +1,135 @@
+"""
+Measure event-loop lag while many requests hit the Mongo-backed auth path.
+
+Runs /api/v1/user concurrently against an in-memory Mongo stand-in (mongomock)
+that injects a fixed per-query latency, once with a blocking pymongo call made
+from async code and once with the async driver path, and reports how long a ticker task
+on the same loop was delayed.
+
+Usage:
+    pip install mongomock mongomock-motor
+    python benchmarks/event_loop_lag.py --requests 200 --concurrency 50 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+import mongomock
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+
+TEST_USER = {"email": "bench@example.com", "name": "Bench User", "picture": None}
+
+
+class SlowSyncCollection:
+    """Blocking collection wrapper, like pymongo against a slow server"""
+
+    def __init__(self, collection, latency):
+        self.collection = collection
+        self.latency = latency
+
+    def find_one(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return self.collection.find_one(*args, **kwargs)
+
+
+class SlowAsyncCollection:
+    """Non-blocking collection wrapper, like motor against a slow server"""
+
+    def __init__(self, collection, latency):
+        self.collection = collection
+        self.latency = latency
+
+    async def find_one(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await self.collection.find_one(*args, **kwargs)
+
+
+def legacy_dependency(collection):
+    """A blocking pymongo find_one inside an async dependency, as the pre-motor auth_callback did its upsert
+
+    A plain def would run in the threadpool and leave the loop free, hiding the stall being measured.
+    """
+    async def get_user_from_token(token: str = main.Cookie(None)):
+        if not token:
+            return None
+        try:
+            payload = main.jwt.decode(token, main.SECRET_KEY, algorithms=[main.ALGORITHM])
+        except main.JWTError:
+            return None
+        user = collection.find_one({"email": payload.get("sub")})
+        return main.UserInDB(**user) if user else None
+    return get_user_from_token
+
+
+async def measure_lag(stop: asyncio.Event, interval: float, samples: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run_scenario(name, total, concurrency):
+    token = main.create_access_token({"sub": TEST_USER["email"]})
+    transport = httpx.ASGITransport(app=main.app)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies={"token": token}) as client:
+        async def one_request():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.get("/api/v1/user")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        lag_samples = []
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(measure_lag(stop, 0.005, lag_samples))
+        started = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(total)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await ticker
+
+    latencies.sort()
+    lag_samples.sort()
+    print(f"{name}:")
+    print(f"  throughput      {total / elapsed:8.1f} req/s")
+    print(f"  latency p50/p99 {statistics.median(latencies) * 1000:8.1f} / {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms")
+    print(f"  loop lag p50    {statistics.median(lag_samples) * 1000:8.1f} ms")
+    print(f"  loop lag max    {lag_samples[-1] * 1000:8.1f} ms")
+
+
+async def run(args):
+    sync_collection = mongomock.MongoClient()["chatgpt_clone"]["users"]
+    sync_collection.insert_one(dict(TEST_USER))
+    async_collection = AsyncMongoMockClient()["chatgpt_clone"]["users"]
+    await async_collection.insert_one(dict(TEST_USER))
+    # Every request should reach the collection, not the token -> user cache
+    main.user_cache = main.TTLCache(0, 0)
+
+    main.app.dependency_overrides[main.get_user_from_token] = legacy_dependency(
+        SlowSyncCollection(sync_collection, args.latency)
+    )
+    await run_scenario("blocking pymongo lookup", args.requests, args.concurrency)
+
+    main.app.dependency_overrides.clear()
+    main.users_collection = SlowAsyncCollection(async_collection, args.latency)
+    await run_scenario("async motor lookup", args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated Mongo latency per query in seconds")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,190 @@
+"""
+Stand-in for the model backend on BACKEND_API_URL, with injectable latency and errors.
+
+Serves /api/v1/chat (JSON, or SSE when the request accepts text/event-stream),
+/api/v1/sessions, /api/v1/conversation-history and /api/v1/clear-conversation.
+Faults can be changed while it runs, which makes it easy to watch the circuit
+breakers open and recover on /api/v1/health/backend:
+
+    curl -X POST localhost:9000/_faults -H 'Content-Type: application/json' \\
+         -d '{"error_rate": 1.0}'
+    curl -X POST localhost:9000/_faults -H 'Content-Type: application/json' \\
+         -d '{"delay": 20, "routes": ["sessions"]}'
+    curl -X POST localhost:9000/_faults -H 'Content-Type: application/json' -d '{"down": true}'
+    curl -X POST localhost:9000/_faults -H 'Content-Type: application/json' -d '{}'   # reset
+
+"down" makes every route, including /health, answer 503. Run several copies
+on different ports to try BACKEND_API_URLS replica balancing. Like a real model
+server, it notices callers that hang up mid-request and stops working on them;
+GET /_faults counts those as "abandoned".
+
+Usage:
+    python benchmarks/fake_backend.py --port 9000 --delay 0.2 --jitter 0.1 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+
+DEFAULT_FAULTS = {"delay": 0.0, "jitter": 0.0, "error_rate": 0.0, "error_status": 500, "routes": None, "down": False}
+faults = dict(DEFAULT_FAULTS)
+stream_settings = {"tokens": 20, "token_delay": 0.02}
+counters = {}
+
+REPLY_WORDS = "the quick brown fox jumps over the lazy dog while the backend streams a reply".split()
+
+
+def count_abandoned(route: str):
+    counters["abandoned"] = counters.get("abandoned", 0) + 1
+    counters[f"{route}_abandoned"] = counters.get(f"{route}_abandoned", 0) + 1
+
+
+async def sleep_unless_disconnected(request: Request, delay: float):
+    """Sleep for delay seconds, returning False early if the caller disconnects"""
+    deadline = time.monotonic() + delay
+    while time.monotonic() < deadline:
+        if await request.is_disconnected():
+            return False
+        await asyncio.sleep(min(0.05, deadline - time.monotonic()))
+    return True
+
+
+async def inject_faults(route: str, request: Request):
+    """Sleep and/or fail according to the current faults; returns an error response or None"""
+    counters[route] = counters.get(route, 0) + 1
+    if faults["down"]:
+        return JSONResponse({"error": "Backend is down"}, status_code=503)
+    if faults["routes"] and route not in faults["routes"]:
+        return None
+    delay = faults["delay"] + random.uniform(0, faults["jitter"])
+    if delay > 0 and not await sleep_unless_disconnected(request, delay):
+        count_abandoned(route)
+        return JSONResponse({"error": "Caller disconnected"}, status_code=499)
+    if random.random() < faults["error_rate"]:
+        return JSONResponse({"error": "Injected failure"}, status_code=faults["error_status"])
+    return None
+
+
+def reply_text(tokens: int):
+    return " ".join(random.choice(REPLY_WORDS) for _ in range(tokens))
+
+
+@app.post("/api/v1/chat")
+async def chat(request: Request):
+    body = await request.json()
+    error = await inject_faults("chat", request)
+    if error:
+        return error
+    text = reply_text(stream_settings["tokens"])
+    final = {
+        "type": "text",
+        "text_content": text,
+        "conversation_id": body.get("conversation_id") or uuid.uuid4().hex,
+        "metadata": None
+    }
+    if "text/event-stream" not in request.headers.get("accept", ""):
+        return final
+
+    async def events():
+        try:
+            for word in text.split(" "):
+                await asyncio.sleep(stream_settings["token_delay"])
+                yield f"data: {json.dumps({'delta': word + ' '})}\n\n"
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+        except asyncio.CancelledError:
+            # Starlette cancels the stream when the caller disconnects
+            count_abandoned("chat_stream")
+            raise
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/api/v1/sessions")
+async def sessions(request: Request):
+    body = await request.json()
+    error = await inject_faults("sessions", request)
+    if error:
+        return error
+    now = int(time.time())
+    return {"sessions": [
+        {
+            "session_id": f"session-{i}",
+            "email_id": body.get("email_id"),
+            "last_message": f"Conversation {i}",
+            "created_at": now - i * 3600,
+            "updated_at": now - i * 60
+        }
+        for i in range(10)
+    ]}
+
+
+@app.post("/api/v1/conversation-history")
+async def conversation_history(request: Request):
+    body = await request.json()
+    error = await inject_faults("conversation-history", request)
+    if error:
+        return error
+    return {
+        "session_id": body.get("session_id"),
+        "messages": [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": reply_text(12)}
+            for i in range(60)
+        ]
+    }
+
+
+@app.post("/api/v1/clear-conversation")
+async def clear_conversation(request: Request):
+    error = await inject_faults("clear-conversation", request)
+    if error:
+        return error
+    return {"type": "info", "text_content": "Conversation history cleared successfully."}
+
+
+@app.get("/health")
+async def health():
+    if faults["down"]:
+        return JSONResponse({"status": "down"}, status_code=503)
+    return {"status": "ok"}
+
+
+@app.get("/_faults")
+async def get_faults():
+    return {"faults": faults, "stream": stream_settings, "requests": counters}
+
+
+@app.post("/_faults")
+async def set_faults(request: Request):
+    """Replace the current faults; omitted fields go back to their defaults"""
+    body = await request.json()
+    faults.clear()
+    faults.update(DEFAULT_FAULTS)
+    faults.update({key: value for key, value in body.items() if key in DEFAULT_FAULTS})
+    return {"faults": faults}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--delay", type=float, default=0.0, help="added latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency of up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--tokens", type=int, default=20, help="words per chat reply")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed words")
+    args = parser.parse_args()
+
+    DEFAULT_FAULTS.update(delay=args.delay, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status)
+    faults.update(DEFAULT_FAULTS)
+    stream_settings.update(tokens=args.tokens, token_delay=args.token_delay)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
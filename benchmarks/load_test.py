@@ -0,0 +1,406 @@
+"""
+Load test main:app against a local fake backend, mongomock and moto.
+
+Starts benchmarks/fake_backend.py and `uvicorn benchmarks.bench_app:app`,
+drives a weighted mix of chat (buffered and streamed), sessions, history
+and upload traffic for a fixed duration, samples the RSS of every uvicorn
+worker, and writes p50/p95/p99 latency, throughput and memory to a JSON file
+under benchmarks/results/. Pass --compare with an earlier result to see the
+change per operation.
+
+Usage:
+    pip install mongomock mongomock-motor "moto[s3]"
+    python benchmarks/load_test.py --workers 2 --concurrency 64 --duration 30
+    python benchmarks/load_test.py --compare benchmarks/results/<earlier>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from jose import jwt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+DEFAULT_MIX = "chat=2,stream=2,sessions=3,history=3,upload=1"
+
+# 1x1 transparent PNG
+PNG_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def process_tree(pid):
+    """pid and all its descendants, read from /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def is_helper_process(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return b"resource_tracker" in f.read()
+    except OSError:
+        return True
+
+
+async def sample_memory(server_pid, stop, samples):
+    """Record RSS per uvicorn process (the master and, with --workers > 1, each worker)"""
+    while not stop.is_set():
+        for pid in process_tree(server_pid):
+            if pid != server_pid and is_helper_process(pid):
+                continue
+            rss = rss_mb(pid)
+            if rss is not None:
+                samples.setdefault(pid, []).append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+class Bench:
+    def __init__(self, client, tokens):
+        self.client = client
+        self.tokens = tokens
+        self.sessions = {}
+
+    def user(self):
+        return random.choice(list(self.tokens.items()))
+
+    async def chat(self, stream=False):
+        email, token = self.user()
+        headers = {"Cookie": f"token={token}"}
+        payload = {"message": "Tell me something interesting", "conversation_id": f"bench-{random.randrange(1000)}"}
+        if not stream:
+            response = await self.client.post("/api/v1/chat", json=payload, headers=headers)
+            return response.status_code, None
+        headers["Accept"] = "text/event-stream"
+        started = time.perf_counter()
+        first_byte = None
+        async with self.client.stream("POST", "/api/v1/chat", json=payload, headers=headers) as response:
+            async for _ in response.aiter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+        return response.status_code, first_byte
+
+    async def stream(self):
+        return await self.chat(stream=True)
+
+    async def sessions_list(self):
+        email, token = self.user()
+        response = await self.client.post("/api/v1/sessions", json={"email_id": email}, headers={"Cookie": f"token={token}"})
+        if response.status_code == 200:
+            self.sessions[email] = [session["session_id"] for session in (response.json() or {}).get("sessions") or []]
+        return response.status_code, None
+
+    async def history(self):
+        email, token = self.user()
+        session_id = random.choice(self.sessions.get(email) or ["session-0"])
+        response = await self.client.post(
+            "/api/v1/conversation-history",
+            json={"session_id": session_id, "email_id": email, "limit": 30},
+            headers={"Cookie": f"token={token}"}
+        )
+        return response.status_code, None
+
+    async def upload(self):
+        email, token = self.user()
+        response = await self.client.post(
+            "/api/v1/upload-image",
+            files={"image": ("bench.png", PNG_BYTES, "image/png")},
+            headers={"Cookie": f"token={token}"}
+        )
+        return response.status_code, None
+
+
+OPERATIONS = {
+    "chat": Bench.chat,
+    "stream": Bench.stream,
+    "sessions": Bench.sessions_list,
+    "history": Bench.history,
+    "upload": Bench.upload,
+}
+
+
+async def drive(args, base_url, tokens, server_pid):
+    weights = parse_mix(args.mix)
+    names = list(weights)
+
+    records = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        bench = Bench(client, tokens)
+
+        async def user_loop(deadline, record):
+            while time.perf_counter() < deadline:
+                name = random.choices(names, weights=[weights[name] for name in names])[0]
+                started = time.perf_counter()
+                try:
+                    status, first_byte = await OPERATIONS[name](bench)
+                except httpx.HTTPError as e:
+                    status, first_byte = type(e).__name__, None
+                if record:
+                    records.append((name, time.perf_counter() - started, status, first_byte))
+
+        if args.warmup:
+            print(f"Warming up for {args.warmup}s")
+            deadline = time.perf_counter() + args.warmup
+            await asyncio.gather(*(user_loop(deadline, False) for _ in range(args.concurrency)))
+
+        print(f"Running {args.concurrency} concurrent clients for {args.duration}s")
+        memory = {}
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_memory(server_pid, stop, memory))
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(user_loop(deadline, True) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await sampler
+    return records, elapsed, memory
+
+
+def summarize(args, records, elapsed, memory, server_pid):
+    operations = {}
+    for name in sorted({record[0] for record in records}):
+        latencies = [latency for op, latency, _, _ in records if op == name]
+        first_bytes = [first for op, _, _, first in records if op == name and first is not None]
+        statuses = {}
+        for op, _, status, _ in records:
+            if op == name:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        errors = sum(count for status, count in statuses.items() if not (status.isdigit() and int(status) < 400))
+        operations[name] = {
+            "count": len(latencies),
+            "errors": errors,
+            "throughput": round(len(latencies) / elapsed, 2),
+            "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "status": statuses,
+        }
+        if first_bytes:
+            operations[name]["first_byte_p50_ms"] = round(percentile(first_bytes, 0.50) * 1000, 2)
+            operations[name]["first_byte_p95_ms"] = round(percentile(first_bytes, 0.95) * 1000, 2)
+
+    all_latencies = [latency for _, latency, _, _ in records]
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": vars(args),
+        "duration": round(elapsed, 2),
+        "requests": len(records),
+        "throughput": round(len(records) / elapsed, 2),
+        "p50_ms": round(percentile(all_latencies, 0.50) * 1000, 2) if all_latencies else None,
+        "p95_ms": round(percentile(all_latencies, 0.95) * 1000, 2) if all_latencies else None,
+        "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 2) if all_latencies else None,
+        "operations": operations,
+        "memory_mb": {
+            str(pid): {
+                "role": "master" if pid == server_pid and len(memory) > 1 else "worker",
+                "start": round(samples[0], 1),
+                "peak": round(max(samples), 1),
+                "end": round(samples[-1], 1)
+            }
+            for pid, samples in memory.items()
+        },
+    }
+
+
+def print_report(result):
+    print(f"\n{result['requests']} requests in {result['duration']}s - {result['throughput']} req/s "
+          f"(p50 {result['p50_ms']} / p95 {result['p95_ms']} / p99 {result['p99_ms']} ms)")
+    print(f"{'operation':<10} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, op in result["operations"].items():
+        print(f"{name:<10} {op['count']:>7} {op['errors']:>7} {op['throughput']:>8} "
+              f"{op['p50_ms']:>9} {op['p95_ms']:>9} {op['p99_ms']:>9}")
+    for pid, memory in result["memory_mb"].items():
+        print(f"{memory['role']} {pid}: RSS {memory['start']} -> peak {memory['peak']} MB (end {memory['end']} MB)")
+
+
+def print_comparison(baseline, result):
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+
+    def change(before, after):
+        if not before:
+            return "n/a"
+        return f"{(after - before) / before * 100:+.1f}%"
+
+    print(f"  throughput {baseline['throughput']} -> {result['throughput']} req/s ({change(baseline['throughput'], result['throughput'])})")
+    for name, op in result["operations"].items():
+        before = baseline.get("operations", {}).get(name)
+        if not before:
+            continue
+        print(f"  {name:<10} p50 {change(before['p50_ms'], op['p50_ms']):>8}  p95 {change(before['p95_ms'], op['p95_ms']):>8}  "
+              f"p99 {change(before['p99_ms'], op['p99_ms']):>8}  errors {before['errors']} -> {op['errors']}")
+    before_peak = sum(memory["peak"] for memory in baseline.get("memory_mb", {}).values())
+    after_peak = sum(memory["peak"] for memory in result["memory_mb"].values())
+    print(f"  peak RSS (all processes) {before_peak:.1f} -> {after_peak:.1f} MB ({change(before_peak, after_peak)})")
+
+
+def wait_until_ready(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{url} exited during startup with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise SystemExit(f"{url} did not become ready within {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent simulated clients")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="unmeasured seconds before the run")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=60, help="client timeout per request in seconds")
+    parser.add_argument("--backend-delay", type=float, default=0.2, help="fake backend latency in seconds")
+    parser.add_argument("--backend-jitter", type=float, default=0.05)
+    parser.add_argument("--backend-error-rate", type=float, default=0.0)
+    parser.add_argument("--tokens", type=int, default=40, help="words per fake chat reply")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed words")
+    parser.add_argument("--keep-limits", action="store_true", help="keep the chat rate limits instead of disabling them")
+    parser.add_argument("--output", help="result file (default benchmarks/results/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    secret = secrets.token_hex(32)
+    backend_port, app_port = free_port(), free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "BACKEND_API_URL": f"http://127.0.0.1:{backend_port}",
+        "SECRET_KEY": secret,
+        "AWS_ACCESS_KEY": "bench",
+        "AWS_SECRET_KEY": "bench",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "S3_BUCKET_NAME": "bench-bucket",
+        "S3_ENDPOINT_URL": "",
+        "BENCH_USERS": str(args.users),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    }
+    if not args.keep_limits:
+        env.update(CHAT_RATE_PER_MINUTE="0", CHAT_MAX_INFLIGHT_PER_USER=str(args.concurrency))
+
+    backend = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_backend.py"),
+        "--port", str(backend_port),
+        "--delay", str(args.backend_delay),
+        "--jitter", str(args.backend_jitter),
+        "--error-rate", str(args.backend_error_rate),
+        "--tokens", str(args.tokens),
+        "--token-delay", str(args.token_delay),
+    ], cwd=ROOT, env=env)
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "benchmarks.bench_app:app",
+        "--port", str(app_port), "--workers", str(args.workers), "--log-level", "warning",
+    ], cwd=ROOT, env=env)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{backend_port}/_faults", backend)
+        wait_until_ready(f"http://127.0.0.1:{app_port}/", server)
+
+        expires = datetime.utcnow() + timedelta(hours=1)
+        tokens = {
+            f"bench-{i}@example.com": jwt.encode({"sub": f"bench-{i}@example.com", "exp": expires}, secret, algorithm="HS256")
+            for i in range(args.users)
+        }
+        records, elapsed, memory = asyncio.run(drive(args, f"http://127.0.0.1:{app_port}", tokens, server.pid))
+    finally:
+        server.terminate()
+        backend.terminate()
+        server.wait()
+        backend.wait()
+
+    result = summarize(args, records, elapsed, memory, server.pid)
+    print_report(result)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{result['commit'] or 'unknown'}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Build fingerprinted, precompressed copies of the static assets.
+
+Each CSS/JS file under static/ is copied to static/dist/ with a content hash
+in its name (css/styles.css -> css/styles.3f2a9c1d0b.css), alongside .gz and,
+when the 'brotli' package is installed, .br versions. static/dist/manifest.json
+maps the source paths to the fingerprinted ones. The app reads it at startup,
+so templates link the hashed files, which are then served with an immutable
+Cache-Control.
+
+Usage:
+    python build_static.py
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+ASSET_EXTENSIONS = (".css", ".js")
+HASH_LENGTH = 10
+
+
+def find_assets():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        # Never fingerprint a previous build
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for name in sorted(files):
+            if name.endswith(ASSET_EXTENSIONS):
+                yield os.path.relpath(os.path.join(root, name), STATIC_DIR)
+
+
+def build_asset(path):
+    with open(os.path.join(STATIC_DIR, path), "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    base, ext = os.path.splitext(path)
+    fingerprinted = f"{base}.{digest}{ext}".replace(os.sep, "/")
+
+    target = os.path.join(DIST_DIR, fingerprinted)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as f:
+        f.write(content)
+    # Compressed once at build time, so use the slowest, smallest settings
+    with open(target + ".gz", "wb") as f:
+        f.write(gzip.compress(content, compresslevel=9))
+    sizes = [len(content), os.path.getsize(target + ".gz")]
+    if brotli:
+        with open(target + ".br", "wb") as f:
+            f.write(brotli.compress(content, quality=11))
+        sizes.append(os.path.getsize(target + ".br"))
+    print(f"{path} -> dist/{fingerprinted} ({' / '.join(str(size) for size in sizes)} bytes)")
+    return fingerprinted
+
+
+def main():
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+    manifest = {path.replace(os.sep, "/"): build_asset(path) for path in find_assets()}
+    with open(os.path.join(DIST_DIR, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    if not brotli:
+        print("brotli is not installed, only .gz files were written")
+    print(f"Wrote {len(manifest)} assets to {DIST_DIR}")
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    main()
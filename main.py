@@ -1,96 +1,2451 @@
-from fastapi import FastAPI, Request, Depends, HTTPException, status, Cookie, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi import FastAPI, Request, Depends, HTTPException, status, Cookie, Header, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import anyio
 import httpx
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
+import sys
 import socket
 import uuid
+import asyncio
+import atexit
 import boto3
-from typing import Optional
+import codecs
+import gzip
+import hashlib
+import io
+import math
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+from urllib.parse import urlparse
 from pydantic import BaseModel, EmailStr
 from datetime import datetime, timedelta
+import mimetypes
 import secrets
-from pymongo import MongoClient
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 from dotenv import load_dotenv
 from jose import JWTError, jwt
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
 
 # Load environment variables
 load_dotenv()
 
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_MAX_FIELD_LENGTH = int(os.getenv("LOG_MAX_FIELD_LENGTH", "1000"))
+LOG_REDACT_EMAILS = os.getenv("LOG_REDACT_EMAILS", "true").lower() == "true"
+# Share of requests whose INFO/DEBUG logs are kept, per route, e.g. "/api/v1/chat=0.1,/api/v1/sessions=0.5"
+LOG_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if "=" in item)
+}
+LOG_DEFAULT_SAMPLE_RATE = float(os.getenv("LOG_DEFAULT_SAMPLE_RATE", "1.0"))
+
+# Route and sampling decision of the request being handled
+log_route: ContextVar[Optional[str]] = ContextVar("log_route", default=None)
+log_sampled: ContextVar[bool] = ContextVar("log_sampled", default=True)
+
+REDACTED_FIELDS = {"token", "access_token", "refresh_token", "authorization", "cookie", "password", "secret", "code"}
+REDACT_PATTERNS = [
+    (re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]+"), "[jwt]"),
+    (re.compile(r"(?i)(bearer\s+)[\w.~+/=-]+"), r"\1[redacted]"),
+]
+EMAIL_PATTERN = re.compile(r"([\w.+-])[\w.+-]*(?:@|%40)([\w-]+\.[\w.-]+)")
+# LogRecord attributes that are not user-supplied `extra` fields
+STANDARD_LOG_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+def scrub_log_value(value):
+    """Truncate and redact a value before it is written to the log"""
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    text = str(value)
+    for pattern, replacement in REDACT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    if LOG_REDACT_EMAILS:
+        text = EMAIL_PATTERN.sub(r"\1***@\2", text)
+    if len(text) > LOG_MAX_FIELD_LENGTH:
+        text = f"{text[:LOG_MAX_FIELD_LENGTH]}... [{len(text) - LOG_MAX_FIELD_LENGTH} chars truncated]"
+    return text
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, with extra fields redacted and long values truncated"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": scrub_log_value(record.getMessage())
+        }
+        route = getattr(record, "route", None)
+        if route:
+            entry["route"] = route
+        for key, value in record.__dict__.items():
+            if key in STANDARD_LOG_FIELDS or key == "route":
+                continue
+            entry[key] = "[redacted]" if key.lower() in REDACTED_FIELDS else scrub_log_value(value)
+        if record.exc_info:
+            entry["exception"] = scrub_log_value(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+class RequestSamplingFilter(logging.Filter):
+    """Drop INFO/DEBUG records of requests that were not sampled; warnings and errors are always kept"""
+
+    def filter(self, record):
+        record.route = log_route.get()
+        return record.levelno >= logging.WARNING or log_sampled.get()
+
+def start_log_sampling(route: str):
+    """Decide whether this request's INFO/DEBUG logs are kept"""
+    rate = LOG_SAMPLE_RATES.get(route, LOG_DEFAULT_SAMPLE_RATE)
+    log_route.set(route)
+    log_sampled.set(rate >= 1.0 or random.random() < rate)
+
+def configure_logging():
+    """Send log records through a queue so formatting and I/O happen off the event loop"""
+    handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestSamplingFilter())
+    # Keep the original record so the JSON formatter sees extra fields and exception info
+    queue_handler.prepare = lambda record: record
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every backend request at INFO, which duplicates the metrics on the hot path
+    logging.getLogger("httpx").setLevel(os.getenv("HTTPX_LOG_LEVEL", "WARNING").upper())
+    
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
 
-# Google OAuth configuration
-CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
-CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
-REDIRECT_URI = "https://aichats.phot.ai/auth/callback" if socket.gethostname() == "iof1582d" else "http://127.0.0.1:8000/auth/callback"
-AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
-TOKEN_URI = "https://oauth2.googleapis.com/token"
-USER_INFO = "https://www.googleapis.com/oauth2/v1/userinfo"
+# Prometheus metrics. With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates all of them
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 180)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to fully serve a request, including streamed bodies",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "Requests currently being served",
+    ["method", "route"],
+    multiprocess_mode="livesum"
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Time spent waiting on the model backend, MongoDB and S3",
+    ["upstream", "operation", "outcome"],
+    buckets=LATENCY_BUCKETS
+)
+
+@contextmanager
+def observe_upstream(upstream: str, operation: str):
+    """Record how long a call to an upstream dependency took and whether it succeeded"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        UPSTREAM_LATENCY.labels(upstream, operation, outcome).observe(time.perf_counter() - started)
+
+# Google OAuth configuration
+CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
+REDIRECT_URI = "https://aichats.phot.ai/auth/callback" if socket.gethostname() == "iof1582d" else "http://127.0.0.1:8000/auth/callback"
+AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+USER_INFO = "https://www.googleapis.com/oauth2/v1/userinfo"
+
+# JWT settings
+SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_hex(32))
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a time-to-live"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def discard_where(self, predicate):
+        """Remove every entry whose value matches predicate, returning how many were removed"""
+        keys = [key for key, (_, value) in self._data.items() if predicate(value)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None
+        }
+
+# Decoded token -> user cache, so most requests skip both jwt.decode and the MongoDB lookup
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def invalidate_cached_user(email: str):
+    user_cache.discard_where(lambda user: user.email == email)
+
+# MongoDB connection
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_TIMEOUT_MS = int(os.getenv("MONGODB_TIMEOUT_MS", "5000"))
+# Async driver so user lookups never block the worker's event loop
+db_client = AsyncIOMotorClient(
+    MONGODB_URI,
+    maxPoolSize=MONGODB_MAX_POOL_SIZE,
+    minPoolSize=MONGODB_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS,
+    connectTimeoutMS=MONGODB_TIMEOUT_MS
+)
+db = db_client["chatgpt_clone"]
+users_collection = db["users"]
+sessions_collection = db["sessions"]
+messages_collection = db["messages"]
+
+# S3 configuration
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "your-bucket-name")
+S3_REGION = os.getenv("S3_REGION", "us-east-1").strip('%')  # Remove any trailing % character
+AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
+# Optional S3-compatible endpoint, e.g. a local moto server or MinIO
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+# Upload limits and multipart tuning; S3 parts are at least 5 MB, so multipart only pays off once
+# UPLOAD_MAX_BYTES is raised past the threshold
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(5 * 1024 * 1024)))
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "4"))
+# Lifetime of presigned POST policies for browser-direct uploads
+PRESIGNED_UPLOAD_EXPIRY = int(os.getenv("PRESIGNED_UPLOAD_EXPIRY", "300"))
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY
+)
+
+# Log S3 configuration (without secret key)
+logger.info(f"S3 Configuration - Bucket: {S3_BUCKET_NAME}, Region: {S3_REGION}")
+logger.info(f"AWS_ACCESS_KEY present: {'Yes' if AWS_ACCESS_KEY else 'No'}")
+
+# S3 client, created at startup; building it is slow enough to keep off import
+s3_client = None
+
+def create_s3_client():
+    if not AWS_ACCESS_KEY or not AWS_SECRET_KEY:
+        logger.warning("AWS credentials are missing. S3 uploads will not work.")
+        return None
+    try:
+        client = boto3.client(
+            's3',
+            region_name=S3_REGION,
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=AWS_ACCESS_KEY,
+            aws_secret_access_key=AWS_SECRET_KEY
+        )
+        logger.info(f"S3 client initialized successfully with region {S3_REGION}")
+        return client
+    except Exception as e:
+        logger.error(f"Error initializing S3 client: {str(e)}")
+        logger.exception("Full S3 client initialization error:")
+        return None
+
+class UploadTooLarge(Exception):
+    pass
+
+class SizeLimitedReader:
+    """Read-only file wrapper that raises UploadTooLarge once more than max_bytes have been read"""
+
+    def __init__(self, fileobj, max_bytes: int):
+        self.fileobj = fileobj
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.start = fileobj.tell() if self.seekable() else 0
+        self.position = 0
+
+    def read(self, size: int = -1):
+        chunk = self.fileobj.read(size)
+        # botocore rereads a seekable body for checksums and retries, so only the furthest position counts
+        self.position += len(chunk)
+        self.bytes_read = max(self.bytes_read, self.position)
+        if self.bytes_read > self.max_bytes:
+            raise UploadTooLarge(f"File exceeds the {self.max_bytes} byte upload limit")
+        return chunk
+
+    # Seeking lets s3transfer size the file and send it from disk instead of buffering it in memory
+    def seekable(self):
+        seekable = getattr(self.fileobj, "seekable", None)
+        if seekable:
+            return seekable()
+        return hasattr(self.fileobj, "seek") and hasattr(self.fileobj, "tell")
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def seek(self, offset: int, whence: int = 0):
+        result = self.fileobj.seek(offset, whence)
+        self.position = self.fileobj.tell() - self.start
+        return result
+
+    def close(self):
+        # s3transfer closes the body after a single-request upload, but the caller owns the file
+        pass
+
+async def upload_to_s3(fileobj, key: str, content_type: str, public: bool = False):
+    """Stream a file object to S3 in a worker thread, using multipart upload above the threshold"""
+    extra_args = {"ContentType": content_type}
+    if public:
+        extra_args["ACL"] = "public-read"
+    reader = SizeLimitedReader(fileobj, UPLOAD_MAX_BYTES)
+    with observe_upstream("s3", "upload"):
+        await run_in_threadpool(
+            s3_client.upload_fileobj,
+            reader,
+            S3_BUCKET_NAME,
+            key,
+            ExtraArgs=extra_args,
+            Config=s3_transfer_config
+        )
+    return reader.bytes_read
+
+# Optional image preprocessing before upload: downscale, re-encode, strip metadata, dedupe by content hash
+IMAGE_PROCESSING = os.getenv("IMAGE_PROCESSING", "false").lower() == "true"
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "webp").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "82"))
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+IMAGE_OUTPUT_TYPES = {"WEBP": ("image/webp", ".webp"), "JPEG": ("image/jpeg", ".jpg")}
+# Animations and vector images are uploaded untouched
+IMAGE_PROCESSING_SKIP_TYPES = {"image/gif", "image/svg+xml"}
+
+if IMAGE_PROCESSING:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logger.warning("IMAGE_PROCESSING is enabled but Pillow is not installed, uploading images unprocessed")
+        IMAGE_PROCESSING = False
+    if IMAGE_OUTPUT_FORMAT not in IMAGE_OUTPUT_TYPES:
+        logger.warning(f"Unsupported IMAGE_OUTPUT_FORMAT {IMAGE_OUTPUT_FORMAT}, using WEBP")
+        IMAGE_OUTPUT_FORMAT = "WEBP"
+
+# Created in the app lifespan when image processing is enabled
+image_process_pool: Optional[ProcessPoolExecutor] = None
+
+def process_image(data: bytes, max_dimension: int, output_format: str, quality: int):
+    """Downscale and re-encode an image without its metadata, returning the bytes and their SHA-256"""
+    from PIL import Image, ImageOps
+    
+    with Image.open(io.BytesIO(data)) as original:
+        # Apply the EXIF orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_dimension, max_dimension))
+        if output_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        output = io.BytesIO()
+        # Saving without exif/icc arguments writes no metadata
+        image.save(output, format=output_format, quality=quality)
+    processed = output.getvalue()
+    return processed, hashlib.sha256(processed).hexdigest()
+
+async def preprocess_image(file: UploadFile):
+    """Run an upload through the process pool, returning (bytes, sha256) or None to upload it as-is"""
+    if image_process_pool is None or file.content_type in IMAGE_PROCESSING_SKIP_TYPES:
+        return None
+    
+    data = await file.read(UPLOAD_MAX_BYTES + 1)
+    if len(data) > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(f"File exceeds the {UPLOAD_MAX_BYTES} byte upload limit")
+    
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            image_process_pool,
+            process_image,
+            data,
+            IMAGE_MAX_DIMENSION,
+            IMAGE_OUTPUT_FORMAT,
+            IMAGE_QUALITY
+        )
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed, uploading original: {str(e)}")
+        await file.seek(0)
+        return None
+
+async def s3_object_exists(key: str):
+    try:
+        with observe_upstream("s3", "head_object"):
+            await run_in_threadpool(s3_client.head_object, Bucket=S3_BUCKET_NAME, Key=key)
+        return True
+    except Exception:
+        return False
+
+async def store_image(file: UploadFile, prefix: str, public: bool = False):
+    """Upload an image to S3 under prefix, preprocessing and deduplicating it when enabled; returns (key, size)"""
+    processed = await preprocess_image(file)
+    if processed is None:
+        key = f"{prefix}/{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
+        size = await upload_to_s3(file.file, key, file.content_type, public=public)
+        return key, size
+    
+    # Processed images are keyed by content hash, so re-uploads of the same image are stored once
+    data, digest = processed
+    content_type, extension = IMAGE_OUTPUT_TYPES[IMAGE_OUTPUT_FORMAT]
+    key = f"{prefix}/{digest}{extension}"
+    if await s3_object_exists(key):
+        logger.info(f"Duplicate image upload, reusing existing object: {key}")
+    else:
+        await upload_to_s3(io.BytesIO(data), key, content_type, public=public)
+    return key, len(data)
+
+def s3_object_url(key: str):
+    if S3_ENDPOINT_URL:
+        return f"{S3_ENDPOINT_URL.rstrip('/')}/{S3_BUCKET_NAME}/{key}"
+    return f"https://{S3_BUCKET_NAME}.s3.{S3_REGION}.amazonaws.com/{key}"
+
+# Upload routes whose request bodies are capped before multipart parsing spools them
+UPLOAD_PATHS = {"/api/v1/upload-image", "/api/v1/direct-upload"}
+# Allowance for multipart boundaries and part headers on top of the file itself
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+class UploadSizeLimitMiddleware:
+    """Reject upload bodies above the limit while they stream in, instead of after they are spooled"""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in UPLOAD_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(
+                content={"detail": f"Upload exceeds the {UPLOAD_MAX_BYTES} byte limit"},
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"Upload exceeds the {UPLOAD_MAX_BYTES} byte limit"
+                    )
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+def resolve_route_name(scope):
+    """Route template for a request, resolved once and kept on the scope"""
+    if "route_name" not in scope:
+        scope["route_name"] = "unmatched"
+        for route in scope["app"].routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                scope["route_name"] = getattr(route, "path", "unmatched")
+                break
+    return scope["route_name"]
+
+class LogSamplingMiddleware:
+    """Make the per-route log sampling decision at the start of each request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            start_log_sampling(resolve_route_name(scope))
+        await self.app(scope, receive, send)
+
+class MetricsMiddleware:
+    """Record per-route latency and in-flight requests for /metrics"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        method = scope["method"]
+        route = resolve_route_name(scope)
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_progress.dec()
+            REQUEST_LATENCY.labels(method, route, str(status_code)).observe(time.perf_counter() - started)
+
+# Compression of dynamic JSON responses; brotli is used when the optional 'brotli' package is installed
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+COMPRESSIBLE_TYPES = ("application/json",)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def accepted_encodings(scope):
+    """Content codings the client accepts, from its Accept-Encoding header"""
+    encodings = set()
+    for part in Headers(scope=scope).get("accept-encoding", "").split(","):
+        name, _, params = part.partition(";")
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name.strip():
+            encodings.add(name.strip().lower())
+    return encodings
+
+def choose_encoding(scope):
+    accepted = accepted_encodings(scope)
+    if brotli and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def compress_body(body: bytes, encoding: str):
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL)
+
+class CompressionMiddleware:
+    """Compress JSON responses above a size threshold; streamed bodies such as SSE pass through untouched"""
+
+    def __init__(self, app, min_size: int):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = choose_encoding(scope)
+        held_start = None
+        
+        async def send_compressed(message):
+            nonlocal held_start
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES) and "content-encoding" not in headers:
+                    # Hold the headers until the body shows whether it is worth compressing
+                    held_start = message
+                    return
+            elif held_start is not None:
+                start, held_start = held_start, None
+                headers = MutableHeaders(raw=list(start["headers"]))
+                headers.add_vary_header("Accept-Encoding")
+                body = message.get("body", b"")
+                if encoding and not message.get("more_body", False) and len(body) >= self.min_size:
+                    body = compress_body(body, encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    # The compressed bytes differ from the identity response, so the validator becomes weak
+                    etag = headers.get("etag")
+                    if etag and not etag.startswith("W/"):
+                        headers["ETag"] = f"W/{etag}"
+                    message = {**message, "body": body}
+                await send({**start, "headers": headers.raw})
+            await send(message)
+        
+        await self.app(scope, receive, send_compressed)
+
+# Backend API configuration
+BACKEND_API_URL = os.getenv("BACKEND_API_URL", "http://localhost:9000")
+# Comma-separated backend replicas; defaults to the single BACKEND_API_URL
+BACKEND_API_URLS = [url.strip().rstrip("/") for url in os.getenv("BACKEND_API_URLS", BACKEND_API_URL).split(",") if url.strip()]
+# "least_outstanding" or "power_of_two"
+BACKEND_BALANCING = os.getenv("BACKEND_BALANCING", "least_outstanding")
+# Keep each conversation on one replica, for backends that hold conversation state in memory
+BACKEND_STICKY = os.getenv("BACKEND_STICKY", "true").lower() == "true"
+BACKEND_HEALTH_PATH = os.getenv("BACKEND_HEALTH_PATH", "/health")
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", "10"))
+BACKEND_HEALTH_TIMEOUT = float(os.getenv("BACKEND_HEALTH_TIMEOUT", "2"))
+# A replica is taken out of rotation after this many consecutive failed requests, until a health check passes
+BACKEND_EJECT_FAILURES = int(os.getenv("BACKEND_EJECT_FAILURES", "3"))
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("BACKEND_MAX_KEEPALIVE_CONNECTIONS", "20"))
+BACKEND_KEEPALIVE_EXPIRY = float(os.getenv("BACKEND_KEEPALIVE_EXPIRY", "30"))
+BACKEND_HTTP2 = os.getenv("BACKEND_HTTP2", "false").lower() == "true"
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "5"))
+BACKEND_POOL_TIMEOUT = float(os.getenv("BACKEND_POOL_TIMEOUT", "10"))
+
+# Read timeouts (seconds) per backend route
+BACKEND_TIMEOUTS = {
+    "chat": float(os.getenv("BACKEND_CHAT_TIMEOUT", "180")),
+    "sessions": float(os.getenv("BACKEND_SESSIONS_TIMEOUT", "30")),
+    "conversation-history": float(os.getenv("BACKEND_HISTORY_TIMEOUT", "30")),
+    "clear-conversation": float(os.getenv("BACKEND_CLEAR_TIMEOUT", "30")),
+}
+
+# Streaming chat: forward backend chunks as they arrive when the browser asks for text/event-stream
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "true").lower() == "true"
+STREAM_MEDIA_TYPES = ("text/event-stream", "application/x-ndjson")
+
+# Circuit breaker per backend route: fail fast after repeated failures or sustained high latency
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+# Also open when the p95 of recent calls exceeds this fraction of the route's timeout
+BREAKER_SLOW_RATIO = float(os.getenv("BREAKER_SLOW_RATIO", "0.8"))
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "50"))
+BREAKER_MIN_SAMPLES = int(os.getenv("BREAKER_MIN_SAMPLES", "10"))
+# Adaptive read timeouts: p99 of recent calls times a multiplier, capped at the route's configured timeout
+ADAPTIVE_TIMEOUTS = os.getenv("ADAPTIVE_TIMEOUTS", "true").lower() == "true"
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "3"))
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("ADAPTIVE_TIMEOUT_MIN", "5"))
+
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+BACKEND_BREAKER_STATE = Gauge(
+    "backend_circuit_state",
+    "Backend circuit breaker state per route (0 closed, 1 half-open, 2 open)",
+    ["route"],
+    multiprocess_mode="livemax"
+)
+
+class BackendUnavailable(Exception):
+    def __init__(self, route: str, retry_after: int):
+        super().__init__(f"Backend route '{route}' is unavailable")
+        self.route = route
+        self.retry_after = retry_after
+
+def percentile(samples, q: float):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CircuitBreaker:
+    """Tracks outcomes and latency of one backend route and rejects calls while the route is failing"""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_reason = None
+        self.probing = False
+        # Recent latencies per operation (e.g. "chat" and "chat_stream")
+        self.latencies = {}
+        self.counters = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+        BACKEND_BREAKER_STATE.labels(route).set(0)
+
+    def set_state(self, state: str):
+        self.state = state
+        BACKEND_BREAKER_STATE.labels(self.route).set(BREAKER_STATE_VALUES[state])
+
+    def before_call(self):
+        """Raise BackendUnavailable while open; returns True when this call is the half-open probe"""
+        if self.state == "open":
+            remaining = self.opened_at + BREAKER_RESET_TIMEOUT - time.monotonic()
+            if remaining > 0:
+                self.counters["rejected"] += 1
+                raise BackendUnavailable(self.route, max(1, int(remaining + 0.999)))
+            self.set_state("half_open")
+        if self.state == "half_open":
+            # Let a single request through to find out whether the backend has recovered
+            if self.probing:
+                self.counters["rejected"] += 1
+                raise BackendUnavailable(self.route, 1)
+            self.probing = True
+            return True
+        return False
+
+    def end_probe(self):
+        self.probing = False
+
+    def record_success(self, operation: str, duration: float):
+        self.counters["successes"] += 1
+        self.consecutive_failures = 0
+        if self.state == "half_open":
+            self.close()
+        self.add_latency(operation, duration)
+        self.check_latency(operation)
+
+    def record_failure(self, operation: str, duration: Optional[float] = None):
+        """Count a failed call; pass the duration when the backend was slow rather than unreachable"""
+        self.counters["failures"] += 1
+        self.consecutive_failures += 1
+        if duration is not None:
+            self.add_latency(operation, duration)
+        if self.state == "half_open":
+            self.open("recovery probe failed")
+        elif self.state == "closed" and self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+            self.open(f"{self.consecutive_failures} consecutive failures")
+        else:
+            self.check_latency(operation)
+
+    def add_latency(self, operation: str, duration: float):
+        samples = self.latencies.get(operation)
+        if samples is None:
+            samples = self.latencies[operation] = deque(maxlen=BREAKER_WINDOW)
+        samples.append(duration)
+
+    def check_latency(self, operation: str):
+        samples = self.latencies.get(operation)
+        if self.state != "closed" or not samples or len(samples) < BREAKER_MIN_SAMPLES:
+            return
+        p95 = percentile(samples, 0.95)
+        if p95 > BACKEND_TIMEOUTS[self.route] * BREAKER_SLOW_RATIO:
+            self.open(f"{operation} p95 latency {p95:.1f}s")
+
+    def open(self, reason: str):
+        self.set_state("open")
+        self.opened_at = time.monotonic()
+        self.open_reason = reason
+        self.probing = False
+        self.counters["opened"] += 1
+        logger.warning(f"Backend circuit opened for {self.route}: {reason}")
+
+    def close(self):
+        self.set_state("closed")
+        self.open_reason = None
+        # Start the latency window afresh so the old slow samples don't reopen the circuit straight away
+        self.latencies.clear()
+        logger.info(f"Backend circuit closed for {self.route}")
+
+    def read_timeout(self, operation: str):
+        """Read timeout for the next call, adapted to the latency observed recently"""
+        limit = BACKEND_TIMEOUTS[self.route]
+        samples = self.latencies.get(operation)
+        if ADAPTIVE_TIMEOUTS and samples and len(samples) >= BREAKER_MIN_SAMPLES:
+            limit = min(limit, max(ADAPTIVE_TIMEOUT_MIN, percentile(samples, 0.99) * ADAPTIVE_TIMEOUT_MULTIPLIER))
+        return limit
+
+    def timeout(self, operation: str):
+        return httpx.Timeout(self.read_timeout(operation), connect=BACKEND_CONNECT_TIMEOUT, pool=BACKEND_POOL_TIMEOUT)
+
+    def stats(self):
+        retry_in = self.opened_at + BREAKER_RESET_TIMEOUT - time.monotonic() if self.state == "open" else None
+        return {
+            "state": self.state,
+            "reason": self.open_reason,
+            "retry_in": round(max(0.0, retry_in), 1) if retry_in is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "latency": {
+                operation: {
+                    "samples": len(samples),
+                    "p50": round(percentile(samples, 0.5), 3),
+                    "p95": round(percentile(samples, 0.95), 3),
+                    "p99": round(percentile(samples, 0.99), 3),
+                    "timeout": round(self.read_timeout(operation), 1)
+                }
+                for operation, samples in self.latencies.items() if samples
+            },
+            **self.counters
+        }
+
+backend_breakers = {route: CircuitBreaker(route) for route in BACKEND_TIMEOUTS}
+
+BACKEND_REPLICA_UP = Gauge(
+    "backend_replica_up",
+    "Whether a backend replica is in rotation",
+    ["replica"],
+    multiprocess_mode="livemin"
+)
+
+class BackendReplica:
+    """One backend replica with its load, health and latency"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.unhealthy_reason = None
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.last_health_check = None
+        self.latencies = deque(maxlen=BREAKER_WINDOW)
+        self.counters = {"requests": 0, "errors": 0, "ejections": 0}
+        BACKEND_REPLICA_UP.labels(url).set(1)
+
+    def start(self):
+        self.outstanding += 1
+        self.counters["requests"] += 1
+
+    def finish(self):
+        self.outstanding -= 1
+
+    def record_success(self, duration: float):
+        self.consecutive_failures = 0
+        self.latencies.append(duration)
+        # Requests still reach an ejected replica when no other is healthy, or between health checks;
+        # one that answers is back, which is the only way a lone replica recovers
+        if not self.healthy:
+            self.set_healthy(True)
+
+    def record_failure(self):
+        self.counters["errors"] += 1
+        self.consecutive_failures += 1
+        if self.healthy and self.consecutive_failures >= BACKEND_EJECT_FAILURES:
+            self.counters["ejections"] += 1
+            self.set_healthy(False, f"{self.consecutive_failures} consecutive failed requests")
+
+    def set_healthy(self, healthy: bool, reason: Optional[str] = None):
+        if healthy != self.healthy:
+            if healthy:
+                logger.info(f"Backend replica {self.url} is back in rotation")
+            else:
+                logger.warning(f"Backend replica {self.url} taken out of rotation: {reason}")
+        self.healthy = healthy
+        self.unhealthy_reason = None if healthy else reason
+        BACKEND_REPLICA_UP.labels(self.url).set(1 if healthy else 0)
+
+    def stats(self):
+        samples = list(self.latencies)
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "reason": self.unhealthy_reason,
+            "outstanding": self.outstanding,
+            "latency_p50": round(percentile(samples, 0.5), 3) if samples else None,
+            "latency_p95": round(percentile(samples, 0.95), 3) if samples else None,
+            "last_health_check": self.last_health_check,
+            **self.counters
+        }
+
+class BackendPool:
+    """Chooses a backend replica per request and keeps track of which replicas are healthy"""
+
+    def __init__(self, urls: List[str]):
+        self.replicas = [BackendReplica(url) for url in urls]
+
+    def choose(self, affinity: Optional[str] = None):
+        # If every replica looks down, keep trying them all rather than failing every request
+        candidates = [replica for replica in self.replicas if replica.healthy] or self.replicas
+        if len(candidates) == 1:
+            return candidates[0]
+        if affinity and BACKEND_STICKY:
+            # Rendezvous hashing: a conversation only moves when its replica leaves the rotation
+            return max(candidates, key=lambda replica: hashlib.sha1(f"{replica.url}|{affinity}".encode()).digest())
+        if BACKEND_BALANCING == "power_of_two":
+            first, second = random.sample(candidates, 2)
+            return first if first.outstanding <= second.outstanding else second
+        fewest = min(replica.outstanding for replica in candidates)
+        return random.choice([replica for replica in candidates if replica.outstanding == fewest])
+
+    def has_alternative(self, replica: BackendReplica):
+        """Whether another healthy replica can take over from this one"""
+        return any(other.healthy for other in self.replicas if other is not replica)
+
+    def replica_for(self, url: httpx.URL):
+        """The replica a request was sent to"""
+        url = str(url)
+        for replica in self.replicas:
+            if url.startswith(replica.url + "/"):
+                return replica
+        return None
+
+    async def check(self, replica: BackendReplica):
+        try:
+            response = await backend_client.get(f"{replica.url}{BACKEND_HEALTH_PATH}", timeout=BACKEND_HEALTH_TIMEOUT)
+            # Any answer below 500 means the process is up, even if it has no health route
+            healthy, reason = response.status_code < 500, f"health check returned {response.status_code}"
+        except httpx.HTTPError as e:
+            healthy, reason = False, f"health check failed: {type(e).__name__}"
+        replica.last_health_check = time.time()
+        if healthy:
+            replica.consecutive_failures = 0
+        replica.set_healthy(healthy, reason)
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+
+    def stats(self):
+        return {
+            "balancing": BACKEND_BALANCING,
+            "sticky": BACKEND_STICKY,
+            "replicas": [replica.stats() for replica in self.replicas]
+        }
+
+backend_pool = BackendPool(BACKEND_API_URLS)
+
+# Shared backend client, created in the app lifespan so every proxy route reuses pooled keep-alive connections
+backend_client: Optional[httpx.AsyncClient] = None
+backend_request_stats = {"total": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0, "cancelled": 0}
+
+def create_backend_client():
+    http2 = BACKEND_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("BACKEND_HTTP2 is enabled but the 'h2' package is not installed, falling back to HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(
+        max_connections=BACKEND_MAX_CONNECTIONS,
+        max_keepalive_connections=BACKEND_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=BACKEND_KEEPALIVE_EXPIRY
+    )
+    logger.info(f"Backend pool - URLs: {', '.join(BACKEND_API_URLS)}, max connections: {BACKEND_MAX_CONNECTIONS}, "
+                f"keep-alive: {BACKEND_MAX_KEEPALIVE_CONNECTIONS} ({BACKEND_KEEPALIVE_EXPIRY}s), HTTP/2: {http2}")
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=backend_timeout("chat"),
+        http2=http2,
+        headers={"Content-Type": "application/json"}
+    )
+
+def backend_timeout(route: str):
+    return httpx.Timeout(BACKEND_TIMEOUTS[route], connect=BACKEND_CONNECT_TIMEOUT, pool=BACKEND_POOL_TIMEOUT)
+
+def track_backend_request():
+    backend_request_stats["total"] += 1
+    backend_request_stats["in_flight"] += 1
+    backend_request_stats["max_in_flight"] = max(backend_request_stats["max_in_flight"], backend_request_stats["in_flight"])
+
+async def backend_post(route: str, payload: dict, params: Optional[dict] = None, affinity: Optional[str] = None):
+    """POST to a backend API route through the shared connection pool, guarded by the route's circuit breaker.
+
+    affinity (a conversation id) keeps related requests on the same replica.
+    """
+    breaker = backend_breakers[route]
+    probe = breaker.before_call()
+    replica = backend_pool.choose(affinity)
+    track_backend_request()
+    replica.start()
+    started = time.perf_counter()
+    try:
+        with observe_upstream("backend", route):
+            response = await backend_client.post(
+                f"{replica.url}/api/v1/{route}",
+                json=payload,
+                params=params,
+                timeout=breaker.timeout(route)
+            )
+        record_backend_response(breaker, replica, route, response, time.perf_counter() - started)
+        return response
+    except Exception as e:
+        backend_request_stats["errors"] += 1
+        record_backend_error(breaker, replica, route, e, time.perf_counter() - started)
+        raise
+    finally:
+        backend_request_stats["in_flight"] -= 1
+        replica.finish()
+        if probe:
+            breaker.end_probe()
+
+async def backend_stream(
+    route: str,
+    payload: dict,
+    params: Optional[dict] = None,
+    headers: Optional[dict] = None,
+    affinity: Optional[str] = None
+):
+    """Open a streaming POST to a backend API route; close it with close_backend_stream"""
+    breaker = backend_breakers[route]
+    operation = f"{route}_stream"
+    probe = breaker.before_call()
+    replica = backend_pool.choose(affinity)
+    track_backend_request()
+    replica.start()
+    request = backend_client.build_request(
+        "POST",
+        f"{replica.url}/api/v1/{route}",
+        json=payload,
+        params=params,
+        headers=headers,
+        timeout=breaker.timeout(operation)
+    )
+    started = time.perf_counter()
+    try:
+        # Measures time until the response headers arrive, which is the wait before the first token
+        with observe_upstream("backend", operation):
+            response = await backend_client.send(request, stream=True)
+        record_backend_response(breaker, replica, operation, response, time.perf_counter() - started)
+        return response
+    except asyncio.CancelledError:
+        # The caller gave up, e.g. the client disconnected, so this says nothing about the backend
+        backend_request_stats["in_flight"] -= 1
+        replica.finish()
+        raise
+    except Exception as e:
+        backend_request_stats["errors"] += 1
+        backend_request_stats["in_flight"] -= 1
+        replica.finish()
+        record_backend_error(breaker, replica, operation, e, time.perf_counter() - started)
+        raise
+    finally:
+        if probe:
+            breaker.end_probe()
+
+def backend_unavailable_response(error: BackendUnavailable):
+    logger.warning(f"Failing fast: {str(error)}")
+    return JSONResponse(
+        content={"detail": "Backend is temporarily unavailable, please try again shortly"},
+        status_code=503,
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def record_backend_response(
+    breaker: CircuitBreaker,
+    replica: BackendReplica,
+    operation: str,
+    response: httpx.Response,
+    duration: float
+):
+    # Server errors count against the route; client errors mean the backend itself is healthy
+    if response.status_code >= 500:
+        replica.record_failure()
+        if not backend_pool.has_alternative(replica):
+            breaker.record_failure(operation, duration)
+    else:
+        breaker.record_success(operation, duration)
+        replica.record_success(duration)
+
+def record_backend_error(breaker: CircuitBreaker, replica: BackendReplica, operation: str, error: Exception, duration: float):
+    if not isinstance(error, httpx.HTTPError):
+        return
+    replica.record_failure()
+    # One bad replica is handled by taking it out of rotation; the route only fails when none are left
+    if backend_pool.has_alternative(replica):
+        return
+    if isinstance(error, httpx.TimeoutException):
+        breaker.record_failure(operation, duration)
+    else:
+        breaker.record_failure(operation)
+
+async def close_backend_stream(response: httpx.Response):
+    await response.aclose()
+    backend_request_stats["in_flight"] -= 1
+    replica = backend_pool.replica_for(response.request.url)
+    if replica:
+        replica.finish()
+
+def record_stream_error(route: str, response: httpx.Response, error: httpx.HTTPError):
+    """Count a backend stream that broke off after its headers arrived"""
+    backend_request_stats["errors"] += 1
+    replica = backend_pool.replica_for(response.request.url)
+    if replica:
+        replica.record_failure()
+    if not (replica and backend_pool.has_alternative(replica)):
+        backend_breakers[route].record_failure(f"{route}_stream")
+    logger.error(f"Backend stream interrupted: {str(error)}")
+
+async def iterate_until(chunks: AsyncIterator, stopped: asyncio.Event):
+    """Yield from chunks until stopped is set, abandoning a read that is still waiting"""
+    stop = asyncio.ensure_future(stopped.wait())
+    chunk = None
+    try:
+        while True:
+            chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait([chunk, stop], return_when=asyncio.FIRST_COMPLETED)
+            if not chunk.done():
+                return
+            try:
+                value = chunk.result()
+            except StopAsyncIteration:
+                return
+            yield value
+    finally:
+        stop.cancel()
+        if chunk is not None and not chunk.done():
+            chunk.cancel()
+            with anyio.CancelScope(shield=True):
+                await asyncio.wait([chunk])
+
+class ReplyTranscript:
+    """Follows a streamed chat reply's events to recover its text, so the finished turn can be stored"""
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.buffer = ""
+        self.text = ""
+        self.final = None
+        self.error = None
+        self.complete = False
+
+    def feed(self, chunk):
+        """Parse relayed SSE bytes, which may split events anywhere"""
+        self.buffer += self.decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        self.buffer = self.buffer.replace("\r\n", "\n")
+        *events, self.buffer = self.buffer.split("\n\n")
+        for raw in events:
+            event, data = "message", []
+            for line in raw.split("\n"):
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data.append(line[6:] if line.startswith("data: ") else line[5:])
+            if data:
+                self.add(event, "\n".join(data))
+
+    def add(self, event: str, data: str):
+        """Take one event; returns its text delta, if it carried one"""
+        if data == "[DONE]":
+            return None
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            payload = {"delta": data}
+        if not isinstance(payload, dict):
+            return None
+        if event == "error" or payload.get("error"):
+            self.error = payload.get("error") or "Stream error"
+            return None
+        delta = payload.get("delta", payload.get("token"))
+        if isinstance(delta, str):
+            self.text += delta
+            return delta
+        if "type" in payload or "text_content" in payload:
+            self.final = payload
+        return None
+
+    def reply(self):
+        """The whole reply, like the buffered response; None unless the stream finished cleanly"""
+        if not self.complete or self.error:
+            return None
+        final = dict(self.final or {"type": "text", "metadata": None})
+        final.setdefault("text_content", self.text)
+        return final
+
+async def relay_backend_stream(
+    route: str,
+    response: httpx.Response,
+    on_close: Optional[Callable[[], Awaitable]] = None,
+    stopped: Optional[asyncio.Event] = None,
+    transcript: Optional[ReplyTranscript] = None
+):
+    """Relay a streaming backend response to the browser as Server-Sent Events, until stopped is set"""
+    if response.headers.get("content-type", "").startswith("application/x-ndjson"):
+        # Re-frame newline-delimited JSON as SSE so the browser only has to parse one format
+        chunks = (f"data: {line}\n\n" async for line in response.aiter_lines() if line.strip())
+    else:
+        chunks = response.aiter_bytes()
+    if stopped:
+        chunks = iterate_until(chunks, stopped)
+    try:
+        async for chunk in chunks:
+            if transcript:
+                transcript.feed(chunk)
+            yield chunk
+        if stopped and stopped.is_set():
+            backend_request_stats["cancelled"] += 1
+            logger.info("Generation stopped, closing backend stream")
+            yield "event: stopped\ndata: {}\n\n"
+        elif transcript:
+            transcript.complete = True
+    except httpx.HTTPError as e:
+        record_stream_error(route, response, e)
+        yield f"event: error\ndata: {json.dumps({'error': 'Backend stream interrupted'})}\n\n"
+    except asyncio.CancelledError:
+        # Starlette cancels the response when the client disconnects
+        backend_request_stats["cancelled"] += 1
+        logger.info("Client disconnected, closing backend stream")
+        raise
+    finally:
+        # Shielded, or a disconnect would cancel the cleanup too and leak the connection and admission slot
+        with anyio.CancelScope(shield=True):
+            await close_backend_stream(response)
+            if on_close:
+                await on_close()
+
+def get_backend_pool_stats():
+    """Connection pool utilisation for the shared backend client"""
+    # httpx does not expose pool state publicly, so read it from the underlying httpcore pool when available
+    pool = getattr(getattr(backend_client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "max_connections": BACKEND_MAX_CONNECTIONS,
+        "max_keepalive_connections": BACKEND_MAX_KEEPALIVE_CONNECTIONS,
+        "keepalive_expiry": BACKEND_KEEPALIVE_EXPIRY,
+        "connections": len(connections),
+        "active_connections": len(connections) - idle,
+        "idle_connections": idle,
+        "utilisation": round((len(connections) - idle) / BACKEND_MAX_CONNECTIONS, 3) if BACKEND_MAX_CONNECTIONS else None,
+        "requests": dict(backend_request_stats),
+        **backend_pool.stats()
+    }
+
+# Read-through cache for session lists and conversation histories
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", "60"))
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", "5000"))
+# Generations and fill versions have to outlive any cached entry or backend read, or a dropped counter
+# could be mistaken for an unchanged one
+READ_CACHE_VERSION_TTL = 3600
+# Optional Redis-compatible store shared by all workers
+REDIS_URL = os.getenv("REDIS_URL")
+
+def create_redis_client():
+    if not REDIS_URL:
+        return None
+    try:
+        import redis.asyncio as redis
+    except ImportError:
+        logger.warning("REDIS_URL is set but the 'redis' package is not installed, using in-process state")
+        return None
+    return redis.from_url(REDIS_URL)
+
+redis_client = create_redis_client()
+
+class MemoryCacheBackend:
+    """Read cache storage local to this worker"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize, ttl)
+        self.generations = TTLCache(maxsize, max(ttl, READ_CACHE_VERSION_TTL))
+        self.versions = TTLCache(maxsize, max(ttl, READ_CACHE_VERSION_TTL))
+        # Bumps draw from one counter, so a counter that expired and restarts never repeats an old value
+        self.counter = 0
+
+    async def get(self, key: str):
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: dict):
+        self.entries.set(key, value)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self.entries.pop(key)
+
+    async def get_generation(self, key: str):
+        return self.generations.get(key, 0)
+
+    async def bump_generation(self, key: str):
+        self.counter += 1
+        self.generations.set(key, self.counter)
+
+    async def get_version(self, key: str):
+        return self.versions.get(key, 0)
+
+    async def bump_version(self, key: str):
+        self.counter += 1
+        self.versions.set(key, self.counter)
+
+class RedisCacheBackend:
+    """Read cache storage in Redis, so invalidations reach every worker"""
+
+    def __init__(self, client, ttl: float):
+        self.client = client
+        self.ttl = ttl
+
+    async def get(self, key: str):
+        raw = await self.client.get(key)
+        return json.loads(raw) if raw else None
+
+    async def set(self, key: str, value: dict):
+        await self.client.set(key, json.dumps(value), ex=max(1, int(self.ttl)))
+
+    async def delete(self, *keys: str):
+        await self.client.delete(*keys)
+
+    async def get_generation(self, key: str):
+        return int(await self.client.get(key) or 0)
+
+    async def bump_generation(self, key: str):
+        await self.client.incr(key)
+        await self.client.expire(key, max(int(self.ttl), READ_CACHE_VERSION_TTL))
+
+    async def get_version(self, key: str):
+        return int(await self.client.get(f"ver:{key}") or 0)
+
+    async def bump_version(self, key: str):
+        await self.client.incr(f"ver:{key}")
+        await self.client.expire(f"ver:{key}", max(int(self.ttl), READ_CACHE_VERSION_TTL))
+
+class ReadCache:
+    """Per-user cache of backend read responses, stored with their ETag"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.stale_fills = 0
+
+    async def _history_key(self, email: str, session_id: str):
+        # Clearing all of a user's conversations bumps the generation instead of scanning for keys
+        generation = await self.backend.get_generation(f"gen:{email}")
+        return f"history:{email}:{generation}:{session_id}"
+
+    async def _get(self, key: str):
+        try:
+            entry = await self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Read cache lookup failed: {str(e)}")
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def _begin_fill(self, key: str):
+        # Taken before the backend fetch; invalidations bump the key's version
+        try:
+            return key, await self.backend.get_version(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Read cache lookup failed: {str(e)}")
+            return key, None
+
+    async def store(self, fill, data):
+        """Cache data fetched under fill, unless the key was invalidated while it was being fetched"""
+        key, version = fill
+        entry = {"etag": make_etag(data), "data": data}
+        if version is None:
+            return entry
+        try:
+            if await self.backend.get_version(key) != version:
+                self.stale_fills += 1
+                return entry
+            await self.backend.set(key, entry)
+            # Invalidations bump before deleting, so one that landed while this was stored gets undone here
+            if await self.backend.get_version(key) != version:
+                self.stale_fills += 1
+                await self.backend.delete(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Read cache store failed: {str(e)}")
+        return entry
+
+    async def get_sessions(self, email: str):
+        return await self._get(f"sessions:{email}")
+
+    async def sessions_fill(self, email: str):
+        return await self._begin_fill(f"sessions:{email}")
+
+    async def get_history(self, email: str, session_id: str):
+        return await self._get(await self._history_key(email, session_id))
+
+    async def history_fill(self, email: str, session_id: str):
+        return await self._begin_fill(await self._history_key(email, session_id))
+
+    async def _invalidate(self, *keys: str):
+        for key in keys:
+            await self.backend.bump_version(key)
+        await self.backend.delete(*keys)
+
+    async def invalidate_conversation(self, email: str, session_id: Optional[str]):
+        """Drop a user's session list and, when given, one conversation's history"""
+        try:
+            keys = [f"sessions:{email}"]
+            if session_id:
+                keys.append(await self._history_key(email, session_id))
+            await self._invalidate(*keys)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Read cache invalidation failed: {str(e)}")
+
+    async def invalidate_user(self, email: str):
+        """Drop everything cached for a user"""
+        try:
+            await self.backend.bump_generation(f"gen:{email}")
+            await self._invalidate(f"sessions:{email}")
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Read cache invalidation failed: {str(e)}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis" if isinstance(self.backend, RedisCacheBackend) else "memory",
+            "ttl": READ_CACHE_TTL,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "stale_fills": self.stale_fills,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None
+        }
+
+# Conversation history pagination
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+# Set when the backend accepts limit/before itself; otherwise the proxy slices full histories
+BACKEND_PAGINATES_HISTORY = os.getenv("BACKEND_PAGINATES_HISTORY", "false").lower() == "true"
+
+# Cursors of pages read from the local message store: the timestamp of the page's oldest message
+LOCAL_CURSOR_PREFIX = "ts:"
+
+class InvalidHistoryCursor(Exception):
+    """A history cursor that can't be paged from"""
+
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+def parse_local_cursor(before: str):
+    """The timestamp in a message store cursor"""
+    try:
+        timestamp = float(before[len(LOCAL_CURSOR_PREFIX):])
+    except ValueError:
+        timestamp = None
+    if timestamp is None or not math.isfinite(timestamp):
+        raise InvalidHistoryCursor("Malformed history cursor")
+    return timestamp
+
+def paginate_history(history_data: dict, limit: int, before: Optional[str]):
+    """Slice a full history to the `limit` messages before the cursor (an index into the message list)"""
+    messages = history_data.get("messages") or []
+    end = len(messages)
+    if before:
+        # Anything else would silently start over from the newest page
+        if not before.isdigit():
+            raise InvalidHistoryCursor("Malformed history cursor")
+        end = min(int(before), end)
+    start = max(0, end - limit)
+    return {
+        **history_data,
+        "messages": messages[start:end],
+        "has_more": start > 0,
+        "next_cursor": str(start) if start > 0 else None,
+        "total": len(messages)
+    }
+
+def make_etag(data):
+    return '"' + hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest() + '"'
+
+def etag_response(entry: dict, if_none_match: Optional[str]):
+    """Return a cached entry, or 304 Not Modified when the client already holds it"""
+    headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+    # Weak comparison, since compressed responses carry the weak form of the tag
+    if if_none_match and entry["etag"] in [re.sub(r"^W/", "", tag.strip()) for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=entry["data"], headers=headers)
+
+def create_read_cache():
+    if redis_client:
+        logger.info("Read cache using Redis")
+        return ReadCache(RedisCacheBackend(redis_client, READ_CACHE_TTL))
+    return ReadCache(MemoryCacheBackend(READ_CACHE_SIZE, READ_CACHE_TTL))
+
+read_cache = create_read_cache()
+
+class SingleFlight:
+    """Lets concurrent identical reads share one in-flight backend call"""
+
+    def __init__(self):
+        self.calls = {}
+        self.counters = {}
+
+    async def do(self, key: tuple, fn: Callable[[], Awaitable]):
+        """Run fn for key, or wait for the call already running for it; key[0] names the route"""
+        counters = self.counters.setdefault(key[0], {"upstream_calls": 0, "coalesced": 0})
+        task = self.calls.get(key)
+        if task is None:
+            counters["upstream_calls"] += 1
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            counters["coalesced"] += 1
+        # Shielded so a caller that disconnects doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def _finished(self, key: tuple, task: asyncio.Future):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved in case every waiter went away
+            task.exception()
+
+    def discard_where(self, predicate):
+        """Stop sharing matching in-flight calls so later callers start a fresh one"""
+        for key in [key for key in self.calls if predicate(key)]:
+            del self.calls[key]
+
+    def stats(self):
+        return {"in_flight": len(self.calls), "routes": {route: dict(counters) for route, counters in self.counters.items()}}
+
+# Keys are (route, user email, request details)
+backend_reads = SingleFlight()
+
+def forget_backend_reads(email: str):
+    """A write changed this user's data, so reads already in flight may return stale results"""
+    backend_reads.discard_where(lambda key: key[1] == email)
+
+# Local message store: chat turns are written behind to MongoDB in batches, so sessions and
+# history can be answered from indexed queries, with the backend as the fallback
+MESSAGE_STORE = os.getenv("MESSAGE_STORE", "true").lower() == "true"
+MESSAGE_STORE_BATCH_SIZE = int(os.getenv("MESSAGE_STORE_BATCH_SIZE", "200"))
+MESSAGE_STORE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_STORE_FLUSH_INTERVAL", "0.5"))
+# Queued messages beyond this are dropped and their sessions re-read from the backend later
+MESSAGE_STORE_MAX_PENDING = int(os.getenv("MESSAGE_STORE_MAX_PENDING", "10000"))
+# After a MongoDB error, reads go straight to the backend for this many seconds
+MESSAGE_STORE_RETRY_AFTER = float(os.getenv("MESSAGE_STORE_RETRY_AFTER", "30"))
+
+class MessageStore:
+    """Write-behind copy of chat turns in sessions_collection/messages_collection.
+
+    A session's history is only read locally once the store holds all of it: the session
+    started through this proxy, or its full history was backfilled from the backend once.
+    Likewise a user's session list is read locally once it has been backfilled.
+    """
+
+    def __init__(self):
+        self.pending_messages = []
+        # (email, session_id) -> session fields to upsert on the next flush
+        self.pending_sessions = {}
+        # Sessions whose local copy is known to be missing turns, until a backfill repairs it
+        self.stale = set()
+        self.backfilled_users = set()
+        self.batch_ready = None
+        self.flush_lock = None
+        self.closed = False
+        self.unavailable_until = 0.0
+        self.tasks = set()
+        self.counters = {
+            "messages_written": 0, "batches": 0, "dropped": 0, "write_errors": 0,
+            "local_reads": 0, "fallback_reads": 0, "read_errors": 0, "backfills": 0
+        }
+
+    def _failed(self, action: str, error: Exception, counter: str = "write_errors"):
+        self.counters[counter] += 1
+        self.unavailable_until = time.monotonic() + MESSAGE_STORE_RETRY_AFTER
+        logger.warning(f"Message store {action} failed: {str(error)}")
+
+    def _available(self):
+        if MESSAGE_STORE and time.monotonic() >= self.unavailable_until:
+            return True
+        if MESSAGE_STORE:
+            self.counters["fallback_reads"] += 1
+        return False
+
+    async def ensure_indexes(self):
+        # Range scans over one session's messages in time order, and a user's sessions by recency
+        await messages_collection.create_index([("email", 1), ("session_id", 1), ("timestamp", 1)])
+        await sessions_collection.create_index([("email", 1), ("session_id", 1)], unique=True)
+        await sessions_collection.create_index([("email", 1), ("updated_at", -1)])
+
+    def _queue_session(self, key: tuple, **fields):
+        session = self.pending_sessions.setdefault(key, {"new": False, "stale": False})
+        for name, value in fields.items():
+            session[name] = (session[name] or value) if name in ("new", "stale") else value
+        if self.batch_ready and len(self.pending_messages) >= MESSAGE_STORE_BATCH_SIZE:
+            self.batch_ready.set()
+
+    def record_turn(self, email: str, session_id: Optional[str], message: str, reply: str, new_session: bool = False):
+        """Queue a finished turn; new_session means the backend saw it start, so nothing older exists"""
+        if not MESSAGE_STORE or not email or not session_id:
+            return
+        key = (email, session_id)
+        if len(self.pending_messages) + 2 > MESSAGE_STORE_MAX_PENDING:
+            self.counters["dropped"] += 2
+            self.mark_stale(email, session_id)
+            return
+        # The reply is stamped just after the message so the pair always sorts in order
+        now = time.time()
+        self.pending_messages.extend([
+            {"email": email, "session_id": session_id, "timestamp": now, "role": "user", "content": message},
+            {"email": email, "session_id": session_id, "timestamp": now + 1e-6, "role": "assistant", "content": reply}
+        ])
+        self._queue_session(key, updated_at=now, last_message=message, new=new_session)
+
+    def mark_stale(self, email: str, session_id: Optional[str]):
+        """The backend may have saved a turn the store never saw, e.g. a reply stopped halfway"""
+        if not MESSAGE_STORE or not email or not session_id:
+            return
+        key = (email, session_id)
+        self.stale.add(key)
+        self._queue_session(key, updated_at=time.time(), stale=True)
+
+    def _has_pending(self, email: str, session_id: Optional[str] = None):
+        if session_id:
+            return (email, session_id) in self.pending_sessions
+        return any(key[0] == email for key in self.pending_sessions)
+
+    async def flush(self):
+        """Write everything queued so far: one bulk upsert of sessions, one insert of messages"""
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            messages, self.pending_messages = self.pending_messages, []
+            sessions, self.pending_sessions = self.pending_sessions, {}
+            if not sessions:
+                return
+            keys = list(sessions)
+            try:
+                result = await sessions_collection.bulk_write([
+                    UpdateOne({"email": email, "session_id": session_id}, self._session_update(sessions[(email, session_id)]), upsert=True)
+                    for email, session_id in keys
+                ], ordered=False)
+                if messages:
+                    await messages_collection.insert_many(messages, ordered=False)
+                # A session that didn't exist locally is complete if it started here, or if its user's
+                # sessions were already backfilled, since the backend would have listed it otherwise
+                created = [keys[index] for index in result.upserted_ids]
+                backfilled = await self._backfilled_users({email for email, _ in created})
+                complete = [
+                    (email, session_id) for email, session_id in created
+                    if not sessions[(email, session_id)]["stale"]
+                    and (sessions[(email, session_id)]["new"] or email in backfilled)
+                ]
+                if complete:
+                    await sessions_collection.bulk_write([
+                        UpdateOne({"email": email, "session_id": session_id}, {"$set": {"complete": True}})
+                        for email, session_id in complete
+                    ], ordered=False)
+                self.counters["batches"] += 1
+                self.counters["messages_written"] += len(messages)
+            except Exception as e:
+                # The turns are lost locally; the backend still has them, so re-read those sessions from it
+                self.counters["dropped"] += len(messages)
+                self._failed("write", e)
+                for email, session_id in keys:
+                    self.stale.add((email, session_id))
+                    self._queue_session((email, session_id), updated_at=sessions[(email, session_id)]["updated_at"], stale=True)
+
+    @staticmethod
+    def _session_update(session: dict):
+        update = {"$set": {"updated_at": session["updated_at"]}, "$setOnInsert": {"created_at": session["updated_at"]}}
+        if "last_message" in session:
+            update["$set"]["last_message"] = session["last_message"]
+        # Sessions start out incomplete; flush() promotes the ones known to have no older history
+        if session["stale"]:
+            update["$set"]["complete"] = False
+        else:
+            update["$setOnInsert"]["complete"] = False
+        return update
+
+    async def _backfilled_users(self, emails: set):
+        missing = [email for email in emails if email not in self.backfilled_users]
+        if missing:
+            async for user in users_collection.find({"email": {"$in": missing}, "sessions_backfilled": True}, {"email": 1}):
+                self.backfilled_users.add(user["email"])
+        return {email for email in emails if email in self.backfilled_users}
+
+    async def run(self):
+        """Create the indexes, then flush queued writes every interval, or as soon as a batch fills up"""
+        self.batch_ready = asyncio.Event()
+        if MESSAGE_STORE:
+            try:
+                await self.ensure_indexes()
+            except Exception as e:
+                logger.warning(f"Could not create message store indexes: {str(e)}")
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), MESSAGE_STORE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+            await self.flush()
+
+    async def sessions(self, email: str):
+        """A user's sessions from the store, newest first, or None when they must come from the backend"""
+        if not self._available():
+            return None
+        try:
+            if not await self._backfilled_users({email}):
+                self.counters["fallback_reads"] += 1
+                return None
+            if self._has_pending(email):
+                await self.flush()
+            sessions = await sessions_collection.find(
+                {"email": email},
+                {"_id": 0, "session_id": 1, "last_message": 1, "created_at": 1, "updated_at": 1}
+            ).sort("updated_at", -1).to_list(None)
+        except Exception as e:
+            self._failed("read", e, "read_errors")
+            return None
+        self.counters["local_reads"] += 1
+        return {"sessions": [{**session, "email_id": email} for session in sessions]}
+
+    async def history(self, email: str, session_id: str, limit: Optional[int], before: Optional[str]):
+        """A session's history, or a page of it, from the store; None when it must come from the backend"""
+        if not self._available():
+            return None
+        # Pages are cursored by timestamp; other cursors came from the backend and stay with it
+        if (email, session_id) in self.stale or (before and not before.startswith(LOCAL_CURSOR_PREFIX)):
+            self.counters["fallback_reads"] += 1
+            return None
+        # Client input, so a bad cursor is the caller's error rather than a store failure
+        before_timestamp = parse_local_cursor(before) if before else None
+        query = {"email": email, "session_id": session_id}
+        projection = {"_id": 0, "email": 0, "session_id": 0}
+        try:
+            if self._has_pending(email, session_id):
+                await self.flush()
+            session = await sessions_collection.find_one(query, {"complete": 1})
+            if not session or not session.get("complete"):
+                self.counters["fallback_reads"] += 1
+                return None
+            if not limit:
+                messages = await messages_collection.find(query, projection).sort("timestamp", 1).to_list(None)
+                self.counters["local_reads"] += 1
+                return {"session_id": session_id, "messages": [self._message(m) for m in messages]}
+            
+            page_query = dict(query)
+            if before_timestamp is not None:
+                page_query["timestamp"] = {"$lt": before_timestamp}
+            # Newest first from the cursor, one extra to tell whether there is an older page
+            newest = await messages_collection.find(page_query, projection).sort("timestamp", -1).limit(limit + 1).to_list(None)
+            total = await messages_collection.count_documents(query)
+        except Exception as e:
+            self._failed("read", e, "read_errors")
+            return None
+        has_more = len(newest) > limit
+        page = list(reversed(newest[:limit]))
+        self.counters["local_reads"] += 1
+        return {
+            "session_id": session_id,
+            "messages": [self._message(m) for m in page],
+            "has_more": has_more,
+            "next_cursor": f"{LOCAL_CURSOR_PREFIX}{page[0]['timestamp']!r}" if has_more else None,
+            "total": total
+        }
+
+    @staticmethod
+    def _message(document: dict):
+        return {key: value for key, value in document.items() if key != "timestamp"}
+
+    def backfill_sessions(self, email: str, sessions_data: dict):
+        """Copy a user's session list from the backend, after which it is read locally"""
+        if MESSAGE_STORE and email not in self.backfilled_users:
+            self._spawn(self._backfill_sessions(email, sessions_data.get("sessions") or []))
+
+    async def _backfill_sessions(self, email: str, sessions: list):
+        try:
+            operations = []
+            for session in sessions:
+                if not session.get("session_id"):
+                    continue
+                query = {"email": email, "session_id": session["session_id"]}
+                fields = {"created_at": session.get("created_at"), "last_message": session.get("last_message")}
+                # Sessions already stored keep their newer local turns; ones a history backfill created
+                # without any details (created_at None) get the backend's
+                operations.append(UpdateOne({**query, "created_at": None}, {"$set": fields, "$max": {"updated_at": session.get("updated_at")}}))
+                operations.append(UpdateOne(query, {"$setOnInsert": {**fields, "updated_at": session.get("updated_at"), "complete": False}}, upsert=True))
+            if operations:
+                await sessions_collection.bulk_write(operations, ordered=False)
+            await users_collection.update_one({"email": email}, {"$set": {"sessions_backfilled": True}})
+            self.backfilled_users.add(email)
+            self.counters["backfills"] += 1
+        except Exception as e:
+            self._failed("backfill", e)
+
+    def backfill_history(self, email: str, session_id: str, history_data: dict, fetched_at: float):
+        """Replace a session's local messages with its full history from the backend, fetched from fetched_at on"""
+        if MESSAGE_STORE and email:
+            self._spawn(self._backfill_history(email, session_id, history_data.get("messages") or [], fetched_at))
+
+    async def _backfill_history(self, email: str, session_id: str, messages: list, fetched_at: float):
+        query = {"email": email, "session_id": session_id}
+        try:
+            if self._has_pending(email, session_id):
+                await self.flush()
+            session = await sessions_collection.find_one(query, {"complete": 1})
+            if session and session.get("complete") and (email, session_id) not in self.stale:
+                return
+            # Turns recorded since the fetch began stay; everything older is replaced by the backend's copy,
+            # stamped just before fetched_at so it sorts ahead of them
+            await messages_collection.delete_many({**query, "timestamp": {"$lt": fetched_at}})
+            if messages:
+                await messages_collection.insert_many([
+                    {
+                        **{key: value for key, value in message.items() if key not in ("_id", "email", "session_id")},
+                        "email": email,
+                        "session_id": session_id,
+                        "timestamp": fetched_at - (len(messages) - index) * 1e-6
+                    }
+                    for index, message in enumerate(messages) if isinstance(message, dict)
+                ], ordered=False)
+            self.stale.discard((email, session_id))
+            await sessions_collection.update_one(
+                query,
+                {"$set": {"complete": True}, "$setOnInsert": {"created_at": None, "updated_at": 0}},
+                upsert=True
+            )
+            self.counters["backfills"] += 1
+        except Exception as e:
+            self._failed("backfill", e)
+
+    async def clear(self, email: str, session_id: Optional[str] = None):
+        """Drop one conversation, or all of a user's, after the backend has cleared them"""
+        if not MESSAGE_STORE or not email:
+            return
+        matches = (lambda key: key == (email, session_id)) if session_id else (lambda key: key[0] == email)
+        self.pending_messages = [m for m in self.pending_messages if not matches((m["email"], m["session_id"]))]
+        self.pending_sessions = {key: value for key, value in self.pending_sessions.items() if not matches(key)}
+        self.stale = {key for key in self.stale if not matches(key)}
+        query = {"email": email, "session_id": session_id} if session_id else {"email": email}
+        try:
+            await messages_collection.delete_many(query)
+            await sessions_collection.delete_many(query)
+        except Exception as e:
+            self._failed("clear", e)
+            if session_id:
+                # Don't serve what may be left of it
+                self.stale.add((email, session_id))
+
+    def _spawn(self, coro):
+        # Hold a reference so the task isn't collected before it finishes
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close(self, writer: asyncio.Task):
+        """Stop the writer once it has flushed whatever is still queued"""
+        for task in list(self.tasks):
+            task.cancel()
+        self.closed = True
+        if self.batch_ready:
+            self.batch_ready.set()
+        await writer
+
+    def stats(self):
+        return {
+            "enabled": MESSAGE_STORE,
+            "pending_messages": len(self.pending_messages),
+            "pending_sessions": len(self.pending_sessions),
+            "stale_sessions": len(self.stale),
+            **self.counters
+        }
+
+message_store = MessageStore()
+
+# Admission control for /api/v1/chat
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "20"))
+CHAT_RATE_BURST = int(os.getenv("CHAT_RATE_BURST", "10"))
+CHAT_MAX_INFLIGHT_PER_USER = int(os.getenv("CHAT_MAX_INFLIGHT_PER_USER", "2"))
+# Concurrent backend chat calls per worker, and how many more may wait for a slot
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "64"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "128"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "10"))
+CHAT_RETRY_AFTER = int(os.getenv("CHAT_RETRY_AFTER", "5"))
+# In-flight slots expire on their own in case a release is ever missed
+CHAT_SLOT_TTL = BACKEND_TIMEOUTS["chat"] + 60
+# How often a worker drops refilled rate buckets and expired slots, so one-off clients don't accumulate
+ADMISSION_SWEEP_INTERVAL = float(os.getenv("ADMISSION_SWEEP_INTERVAL", "60"))
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class MemoryAdmissionStore:
+    """Rate-limit buckets and in-flight slots local to this worker"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.slots = {}
+        self.swept_at = time.monotonic()
+
+    def sweep(self, now: float):
+        """Forget buckets that have refilled and slot sets that have all expired; both act as if absent"""
+        if now - self.swept_at < ADMISSION_SWEEP_INTERVAL:
+            return
+        self.swept_at = now
+        for key in [key for key, (_, _, full_at) in self.buckets.items() if full_at <= now]:
+            del self.buckets[key]
+        for key in [key for key, slots in self.slots.items() if all(expires <= now for expires in slots.values())]:
+            del self.slots[key]
+
+    async def take_token(self, key: str, rate: float, burst: int):
+        """Take a token from the bucket, returning 0 or the seconds until one is available"""
+        now = time.monotonic()
+        self.sweep(now)
+        tokens, updated, _ = self.buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return wait
+
+    async def acquire_slot(self, key: str, slot_id: str, limit: int, ttl: float):
+        now = time.monotonic()
+        self.sweep(now)
+        slots = {slot: expires for slot, expires in self.slots.get(key, {}).items() if expires > now}
+        if len(slots) >= limit:
+            self.slots[key] = slots
+            return False
+        slots[slot_id] = now + ttl
+        self.slots[key] = slots
+        return True
+
+    async def release_slot(self, key: str, slot_id: str):
+        slots = self.slots.get(key)
+        if slots:
+            slots.pop(slot_id, None)
+            if not slots:
+                del self.slots[key]
+
+class RedisAdmissionStore:
+    """Rate-limit buckets and in-flight slots in Redis, so limits hold across workers"""
+
+    TOKEN_BUCKET_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+    ACQUIRE_SLOT_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+        if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then return 0 end
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[2])
+        redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[4])))
+        return 1
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.token_bucket = client.register_script(self.TOKEN_BUCKET_SCRIPT)
+        self.acquire = client.register_script(self.ACQUIRE_SLOT_SCRIPT)
+
+    async def take_token(self, key: str, rate: float, burst: int):
+        return float(await self.token_bucket(keys=[key], args=[rate, burst, time.time()]))
+
+    async def acquire_slot(self, key: str, slot_id: str, limit: int, ttl: float):
+        return bool(await self.acquire(keys=[key], args=[time.time(), slot_id, limit, ttl]))
+
+    async def release_slot(self, key: str, slot_id: str):
+        await self.client.zrem(key, slot_id)
+
+class ChatAdmission:
+    """Per-user rate and concurrency limits plus a bounded wait for this worker's backend slots"""
+
+    def __init__(self, store):
+        self.store = store
+        self.semaphore = asyncio.Semaphore(CHAT_MAX_CONCURRENCY)
+        self.waiting = 0
+        self.counters = {"admitted": 0, "rate_limited": 0, "user_limited": 0, "queue_full": 0, "queue_timeout": 0, "store_errors": 0}
+
+    async def acquire(self, client_key: str):
+        """Admit a chat request, returning an idempotent release coroutine function or raising AdmissionRejected"""
+        slot_key = f"chat:inflight:{client_key}"
+        slot_id = uuid.uuid4().hex
+        
+        try:
+            if CHAT_RATE_PER_MINUTE > 0:
+                wait = await self.store.take_token(f"chat:rate:{client_key}", CHAT_RATE_PER_MINUTE / 60, CHAT_RATE_BURST)
+                if wait > 0:
+                    self.counters["rate_limited"] += 1
+                    raise AdmissionRejected(429, "Too many messages, please slow down", max(1, int(wait + 0.999)))
+            
+            if not await self.store.acquire_slot(slot_key, slot_id, CHAT_MAX_INFLIGHT_PER_USER, CHAT_SLOT_TTL):
+                self.counters["user_limited"] += 1
+                raise AdmissionRejected(429, "Too many requests in progress, please wait for a reply", CHAT_RETRY_AFTER)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            # Fail open: a store outage shouldn't take chat down with it
+            self.counters["store_errors"] += 1
+            logger.warning(f"Admission store error, admitting request: {str(e)}")
+            slot_key = None
+        
+        try:
+            # Reject immediately rather than queue without bound when the backend is saturated
+            if self.semaphore.locked() and self.waiting >= CHAT_MAX_QUEUE:
+                self.counters["queue_full"] += 1
+                raise AdmissionRejected(503, "Server is busy, please try again shortly", CHAT_RETRY_AFTER)
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=CHAT_QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.counters["queue_timeout"] += 1
+                raise AdmissionRejected(503, "Server is busy, please try again shortly", CHAT_RETRY_AFTER)
+            finally:
+                self.waiting -= 1
+        except AdmissionRejected:
+            if slot_key:
+                await self.release_slot(slot_key, slot_id)
+            raise
+        
+        self.counters["admitted"] += 1
+        released = False
+        
+        async def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.semaphore.release()
+            if slot_key:
+                await self.release_slot(slot_key, slot_id)
+        
+        return release
+
+    async def release_slot(self, slot_key: str, slot_id: str):
+        try:
+            await self.store.release_slot(slot_key, slot_id)
+        except Exception as e:
+            self.counters["store_errors"] += 1
+            logger.warning(f"Admission store error releasing slot: {str(e)}")
+
+    def stats(self):
+        return {
+            "store": "redis" if isinstance(self.store, RedisAdmissionStore) else "memory",
+            "max_concurrency": CHAT_MAX_CONCURRENCY,
+            "in_flight": CHAT_MAX_CONCURRENCY - self.semaphore._value,
+            "waiting": self.waiting,
+            **self.counters
+        }
+
+chat_admission = ChatAdmission(RedisAdmissionStore(redis_client) if redis_client else MemoryAdmissionStore())
+
+class ChatStopped(Exception):
+    """The client disconnected or stopped the generation before the backend replied"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class ChatStops:
+    """Stop switches for the chat requests in flight on this worker, keyed by client and request id"""
+
+    CHANNEL = "chat:stop"
+
+    def __init__(self, client):
+        # With Redis, stops are broadcast so they reach whichever worker is running the request
+        self.client = client
+        self.events = {}
+        self.counters = {"stop_requests": 0, "stopped": 0, "forwarded": 0}
+
+    def register(self, client_key: str, request_id: str):
+        stopped = asyncio.Event()
+        self.events[(client_key, request_id)] = stopped
+        return stopped
+
+    def unregister(self, client_key: str, request_id: str):
+        self.events.pop((client_key, request_id), None)
+
+    def stop_local(self, client_key: str, request_id: str):
+        stopped = self.events.get((client_key, request_id))
+        if stopped is None or stopped.is_set():
+            return False
+        stopped.set()
+        self.counters["stopped"] += 1
+        return True
+
+    async def stop(self, client_key: str, request_id: str):
+        """Stop a request here, or forward the stop to the other workers; returns what happened"""
+        self.counters["stop_requests"] += 1
+        if self.stop_local(client_key, request_id):
+            return "stopped"
+        if not self.client:
+            return "not_found"
+        try:
+            await self.client.publish(self.CHANNEL, json.dumps({"client_key": client_key, "request_id": request_id}))
+        except Exception as e:
+            logger.warning(f"Failed to forward chat stop: {str(e)}")
+            return "not_found"
+        self.counters["forwarded"] += 1
+        return "forwarded"
+
+    async def listen(self):
+        """Apply stops forwarded by other workers; runs until cancelled"""
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        data = json.loads(message["data"])
+                        self.stop_local(data["client_key"], data["request_id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Chat stop listener failed, resubscribing: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def stats(self):
+        return {"in_flight": len(self.events), **self.counters}
+
+chat_stops = ChatStops(redis_client)
+
+async def wait_for_disconnect(request: Request):
+    """Return once the client has gone away; only call after the request body has been read"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def run_until_stopped(call: Awaitable, request: Optional[Request], stopped: asyncio.Event):
+    """Await a backend call, cancelling it if the client disconnects or the generation is stopped first"""
+    call = asyncio.ensure_future(call)
+    watchers = [asyncio.ensure_future(stopped.wait())]
+    if request is not None:
+        watchers.append(asyncio.ensure_future(wait_for_disconnect(request)))
+    try:
+        await asyncio.wait([call, *watchers], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for watcher in watchers:
+            watcher.cancel()
+        if not call.done():
+            # Cancelling closes the upstream connection, so the backend stops generating too
+            call.cancel()
+            await asyncio.wait([call])
+            backend_request_stats["cancelled"] += 1
+    if call.cancelled():
+        raise ChatStopped("stopped" if stopped.is_set() else "disconnected")
+    return call.result()
+
+# Readiness: dependency checks run in parallel, each with its own timeout, and results are reused briefly
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", "3"))
+READY_CHECK_TTL = float(os.getenv("READY_CHECK_TTL", "5"))
+# Checks that must pass for /readyz. The backend is left out by default: taking every worker out of
+# rotation doesn't help when the shared backend is down, and the circuit breakers already fail fast
+READY_REQUIRED = {name.strip() for name in os.getenv("READY_REQUIRED", "mongodb,s3,redis").split(",") if name.strip()}
+
+class DependencyCheck:
+    """A readiness check for one dependency; a slow check keeps running in the background rather than piling up"""
+
+    def __init__(self, name: str, check: Callable[[], Awaitable]):
+        self.name = name
+        self.check = check
+        self.required = name in READY_REQUIRED
+        self.task = None
+        self.reported = True
+
+    async def run(self):
+        if self.reported:
+            self.task = asyncio.ensure_future(self.timed())
+            self.reported = False
+        try:
+            # Shielded so a timed-out check is picked up again by the next probe instead of restarted
+            result = await asyncio.wait_for(asyncio.shield(self.task), READY_CHECK_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {"ok": False, "required": self.required, "error": f"timed out after {READY_CHECK_TIMEOUT:g}s"}
+        self.reported = True
+        return result
+
+    async def timed(self):
+        started = time.perf_counter()
+        try:
+            await self.check()
+            error = None
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        return {
+            "ok": error is None,
+            "required": self.required,
+            "error": error,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+
+class Readiness:
+    """Whether this worker's dependencies are reachable, for /readyz"""
+
+    def __init__(self):
+        self.checks = []
+        self.results = None
+        self.ready = False
+        self.checked_at = 0.0
+        self.flight = SingleFlight()
+
+    def add(self, name: str, check: Callable[[], Awaitable]):
+        self.checks.append(DependencyCheck(name, check))
+
+    async def run_checks(self):
+        results = await asyncio.gather(*(check.run() for check in self.checks))
+        self.results = {check.name: result for check, result in zip(self.checks, results)}
+        self.ready = all(result["ok"] for result in self.results.values() if result["required"])
+        self.checked_at = time.monotonic()
+        failed = [name for name, result in self.results.items() if not result["ok"]]
+        if failed:
+            logger.warning(f"Readiness checks failed: {', '.join(failed)}")
+        return self.results
+
+    async def status(self):
+        # Only a passing result is reused; while not ready, every probe checks again (slow checks are not restarted)
+        if not self.ready or time.monotonic() - self.checked_at > READY_CHECK_TTL:
+            # Probes from several load balancers share one round of checks
+            await self.flight.do(("readiness",), self.run_checks)
+        return self.ready, self.results
+
+async def check_mongodb():
+    await db_client.admin.command("ping")
+
+async def check_s3():
+    if not s3_client:
+        raise RuntimeError("S3 client is not configured")
+    await run_in_threadpool(s3_client.head_bucket, Bucket=S3_BUCKET_NAME)
+
+async def check_redis():
+    await redis_client.ping()
+
+async def check_backend():
+    # Probed directly rather than through the replica health checks, so readiness never changes routing
+    async def probe(replica: BackendReplica):
+        response = await backend_client.get(f"{replica.url}{BACKEND_HEALTH_PATH}", timeout=READY_CHECK_TIMEOUT)
+        return response.status_code < 500
+    results = await asyncio.gather(*(probe(replica) for replica in backend_pool.replicas), return_exceptions=True)
+    if not any(result is True for result in results):
+        raise RuntimeError("no backend replica is reachable")
+
+def create_readiness():
+    readiness = Readiness()
+    readiness.add("mongodb", check_mongodb)
+    if AWS_ACCESS_KEY and AWS_SECRET_KEY:
+        readiness.add("s3", check_s3)
+    if redis_client:
+        readiness.add("redis", check_redis)
+    readiness.add("backend", check_backend)
+    return readiness
 
-# JWT settings
-SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_hex(32))
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+readiness = create_readiness()
 
-# MongoDB connection
-MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-db_client = MongoClient(MONGODB_URI)
-db = db_client["chatgpt_clone"]
-users_collection = db["users"]
-sessions_collection = db["sessions"]
-messages_collection = db["messages"]
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global backend_client, image_process_pool, s3_client
+    backend_client = create_backend_client()
+    # Off the event loop, and without waiting on S3 itself; /readyz reports whether the bucket is reachable
+    s3_client = await run_in_threadpool(create_s3_client)
+    # First round of readiness checks in the background: warms up connections without holding up startup
+    warm_up = asyncio.create_task(readiness.status())
+    # A single backend has nowhere else to send traffic, so only pools of replicas are health checked
+    health_checks = asyncio.create_task(backend_pool.run_health_checks()) if len(backend_pool.replicas) > 1 else None
+    stop_listener = asyncio.create_task(chat_stops.listen()) if redis_client else None
+    message_writer = asyncio.create_task(message_store.run())
+    if IMAGE_PROCESSING:
+        image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+        logger.info(f"Image preprocessing enabled - max dimension: {IMAGE_MAX_DIMENSION}, "
+                    f"format: {IMAGE_OUTPUT_FORMAT}, quality: {IMAGE_QUALITY}")
+    yield
+    if health_checks:
+        health_checks.cancel()
+    if stop_listener:
+        stop_listener.cancel()
+    warm_up.cancel()
+    # Write out turns still queued before the worker exits
+    await message_store.close(message_writer)
+    await backend_client.aclose()
+    if redis_client:
+        await redis_client.aclose()
+    if image_process_pool:
+        image_process_pool.shutdown()
 
-# S3 configuration
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "your-bucket-name")
-S3_REGION = os.getenv("S3_REGION", "us-east-1").strip('%')  # Remove any trailing % character
-AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
-AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware, min_size=COMPRESS_MIN_SIZE)
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD)
+app.add_middleware(LogSamplingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
-# Log S3 configuration (without secret key)
-logger.info(f"S3 Configuration - Bucket: {S3_BUCKET_NAME}, Region: {S3_REGION}")
-logger.info(f"AWS_ACCESS_KEY present: {'Yes' if AWS_ACCESS_KEY else 'No'}")
+# Static assets. build_static.py writes content-hashed copies, with .gz/.br siblings, under static/dist
+STATIC_DIST_DIR = "dist"
+STATIC_MANIFEST_PATH = os.path.join("static", STATIC_DIST_DIR, "manifest.json")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PRECOMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
 
-# S3 client
-try:
-    if not AWS_ACCESS_KEY or not AWS_SECRET_KEY:
-        logger.warning("AWS credentials are missing. S3 uploads will not work.")
-        s3_client = None
-    else:
-        s3_client = boto3.client(
-            's3',
-            region_name=S3_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY,
-            aws_secret_access_key=AWS_SECRET_KEY
-        )
-        logger.info(f"S3 client initialized successfully with region {S3_REGION}")
+def load_static_manifest():
+    """Map of source asset path to fingerprinted path, empty until build_static.py has been run"""
+    try:
+        with open(STATIC_MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logger.info("No static manifest found, serving unfingerprinted assets")
+        return {}
+    # The build isn't checked in, so it can predate the sources; a stale copy would be cached as immutable
+    current = {path: fingerprinted for path, fingerprinted in manifest.items() if static_build_current(path, fingerprinted)}
+    for path in manifest.keys() - current.keys():
+        logger.warning(f"Static build of {path} is out of date, serving it unfingerprinted; re-run build_static.py")
+    logger.info(f"Loaded static manifest with {len(current)} fingerprinted assets")
+    return current
+
+def static_build_current(path: str, fingerprinted: str):
+    """Whether a fingerprinted build exists and its hash matches the source file"""
+    try:
+        with open(os.path.join("static", path), "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return False
+    built_hash = os.path.splitext(os.path.splitext(fingerprinted)[0])[1].lstrip(".")
+    return (
+        bool(built_hash)
+        and digest.startswith(built_hash)
+        and os.path.exists(os.path.join("static", STATIC_DIST_DIR, fingerprinted))
+    )
+
+static_manifest = load_static_manifest()
+
+def static_url(path: str):
+    """URL of a static asset, preferring its fingerprinted build"""
+    fingerprinted = static_manifest.get(path)
+    if fingerprinted:
+        return f"/static/{STATIC_DIST_DIR}/{fingerprinted}"
+    return f"/static/{path}"
+
+class PrecompressedStaticFiles(StaticFiles):
+    """Serve fingerprinted assets as immutable, using a precompressed sibling the client accepts"""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        relative = os.path.relpath(full_path, self.directory)
+        if not relative.startswith(STATIC_DIST_DIR + os.sep):
+            # Unversioned files may change under the same URL, so browsers revalidate them
+            response = super().file_response(full_path, stat_result, scope, status_code)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
         
-        # Test if we can access the bucket
-        try:
-            s3_client.head_bucket(Bucket=S3_BUCKET_NAME)
-            logger.info(f"Successfully connected to S3 bucket: {S3_BUCKET_NAME}")
-        except Exception as bucket_error:
-            logger.error(f"Error accessing S3 bucket {S3_BUCKET_NAME}: {str(bucket_error)}")
-            logger.warning("S3 uploads may fail due to bucket access issues")
-except Exception as e:
-    logger.error(f"Error initializing S3 client: {str(e)}")
-    logger.exception("Full S3 client initialization error:")
-    s3_client = None
-
-app = FastAPI()
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+        accepted = accepted_encodings(scope)
+        for encoding, suffix in PRECOMPRESSED_SUFFIXES.items():
+            if encoding not in accepted:
+                continue
+            try:
+                compressed_stat = os.stat(f"{full_path}{suffix}")
+            except OSError:
+                continue
+            response = FileResponse(
+                f"{full_path}{suffix}",
+                status_code=status_code,
+                stat_result=compressed_stat,
+                method=scope["method"],
+                media_type=mimetypes.guess_type(str(full_path))[0],
+                headers={**headers, "Content-Encoding": encoding}
+            )
+            break
+        else:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, method=scope["method"], headers=headers)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
 
 # Mount static files directory
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
 
 # Set up templates
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["static_url"] = static_url
+
+# The chat page is rendered once; only the serverUser assignment differs between requests
+SHELL_USER_PLACEHOLDER = "const serverUser = null;"
+
+class ChatShell:
+    """Pre-rendered chat.html with per-user data substituted into one script assignment"""
 
-# Backend API URL
-BACKEND_API_URL = "http://localhost:9000"
+    def __init__(self, html: str):
+        head, placeholder, tail = html.partition(SHELL_USER_PLACEHOLDER)
+        if not placeholder:
+            raise RuntimeError("chat.html no longer contains the serverUser placeholder")
+        self.head = head.encode()
+        self.tail = tail.encode()
+        self.anonymous = html.encode()
+        self.digest = hashlib.sha1(self.anonymous).hexdigest()
+
+    def render(self, server_user: Optional[dict]):
+        """Page bytes and ETag for a user, or for an anonymous visitor when server_user is None"""
+        if server_user is None:
+            return self.anonymous, f'"{self.digest}"'
+        # Escape characters that could end the <script> block early
+        user_json = json.dumps(server_user).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+        body = self.head + f"const serverUser = {user_json};".encode() + self.tail
+        return body, '"' + hashlib.sha1(f"{self.digest}:{user_json}".encode()).hexdigest() + '"'
+
+def render_chat_shell():
+    return ChatShell(templates.get_template("chat.html").render())
+
+chat_shell = render_chat_shell()
 
 # Pydantic models for request validation
 class EmailRequest(BaseModel):
@@ -99,11 +2454,23 @@ class EmailRequest(BaseModel):
 class SessionRequest(BaseModel):
     session_id: str
     email_id: Optional[EmailStr] = None
+    # Pagination: latest `limit` messages, or those before the `before` cursor
+    limit: Optional[int] = None
+    before: Optional[str] = None
 
 class ClearConversationRequest(BaseModel):
     conversation_id: Optional[str] = None
     email_id: Optional[EmailStr] = None
 
+class BatchClearRequest(BaseModel):
+    conversation_ids: List[str]
+    email_id: Optional[EmailStr] = None
+
+class BatchHistoryRequest(BaseModel):
+    session_ids: List[str]
+    email_id: Optional[EmailStr] = None
+    limit: Optional[int] = None
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -116,6 +2483,17 @@ class UserInDB(BaseModel):
     name: Optional[str] = None
     picture: Optional[str] = None
 
+class ChatStopRequest(BaseModel):
+    request_id: str
+
+class UploadUrlRequest(BaseModel):
+    filename: str
+    content_type: str
+    size: Optional[int] = None
+
+class UploadCompleteRequest(BaseModel):
+    key: str
+
 class ChatRequest(BaseModel):
     message: str
     conversation_id: str
@@ -133,9 +2511,14 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_user_from_token(token: str = Cookie(None)):
+async def get_user_from_token(token: str = Cookie(None)):
     if not token:
         return None
+    
+    cached_user = user_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -145,11 +2528,31 @@ def get_user_from_token(token: str = Cookie(None)):
     except JWTError:
         return None
     
-    user = users_collection.find_one({"email": token_data.email})
+    with observe_upstream("mongodb", "find_user"):
+        user = await users_collection.find_one({"email": token_data.email})
     if user:
-        return UserInDB(**user)
+        user = UserInDB(**user)
+        # Never keep a token cached past its own expiry
+        ttl = min(USER_CACHE_TTL, payload.get("exp", 0) - time.time()) if "exp" in payload else USER_CACHE_TTL
+        if ttl > 0:
+            user_cache.set(token, user, ttl=ttl)
+        return user
     return None
 
+def shell_user(token: Optional[str]):
+    """User data for the chat page from the user cache or the token itself, never MongoDB"""
+    if not token:
+        return None
+    user = user_cache.get(token)
+    if user:
+        return {"email": user.email, "name": user.name, "picture": user.picture}
+    try:
+        email = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+    # Not cached on this worker, so the page loads the full profile from /api/v1/user
+    return {"email": email, "name": None, "picture": None, "pending": True} if email else None
+
 # Authentication dependency
 async def get_current_user(user: Optional[UserInDB] = Depends(get_user_from_token)):
     if user is None:
@@ -162,8 +2565,13 @@ async def get_current_user(user: Optional[UserInDB] = Depends(get_user_from_toke
 
 # Routes
 @app.get("/", response_class=HTMLResponse)
-async def get_chat_page(request: Request, user: Optional[UserInDB] = Depends(get_user_from_token)):
-    return templates.TemplateResponse("chat.html", {"request": request, "user": user})
+async def get_chat_page(token: str = Cookie(None), if_none_match: Optional[str] = Header(None)):
+    """Serve the pre-rendered chat page with the signed-in user spliced in"""
+    body, etag = chat_shell.render(shell_user(token))
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match and etag in [re.sub(r"^W/", "", tag.strip()) for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=body, headers=headers)
 
 @app.get("/login/google")
 async def login_google():
@@ -209,13 +2617,14 @@ async def auth_callback(code: str, request: Request):
             }
             
             # Upsert user (insert if not exists, update if exists)
-            print(f"User data: {user_data}")
-            users_collection.update_one(
-                {"email": user_info["email"]},
-                {"$set": user_data},
-                upsert=True
-            )
-            print(f"User data upserted: {users_collection}")
+            logger.info("Saving user after Google login", extra={"email": user_data["email"]})
+            with observe_upstream("mongodb", "upsert_user"):
+                await users_collection.update_one(
+                    {"email": user_info["email"]},
+                    {"$set": user_data},
+                    upsert=True
+                )
+            invalidate_cached_user(user_info["email"])
             # Create access token
             access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
             access_token = create_access_token(
@@ -242,17 +2651,164 @@ async def auth_callback(code: str, request: Request):
         )
 
 @app.get("/logout")
-async def logout():
+async def logout(token: str = Cookie(None)):
     """Logout user by clearing token cookie"""
+    if token:
+        user_cache.pop(token)
     response = RedirectResponse(url="/?just_logged_out=true")
     response.delete_cookie(key="token")
     return response
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/api/v1/stats")
+async def get_stats():
+    """Runtime stats for monitoring"""
+    return {
+        "backend_pool": get_backend_pool_stats(),
+        "user_cache": user_cache.stats(),
+        "read_cache": read_cache.stats(),
+        "read_coalescing": backend_reads.stats(),
+        "chat_admission": chat_admission.stats(),
+        "chat_stops": chat_stops.stats(),
+        "chat_websocket": chat_generations.stats(),
+        "message_store": message_store.stats(),
+        "backend_breakers": {route: breaker.stats() for route, breaker in backend_breakers.items()}
+    }
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the worker is up and its event loop is responding"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the dependencies this worker needs are reachable"""
+    ready, checks = await readiness.status()
+    return JSONResponse(
+        content={"status": "ready" if ready else "not_ready", "checks": checks},
+        status_code=200 if ready else 503
+    )
+
+@app.get("/api/v1/health/backend")
+async def get_backend_health():
+    """Circuit breaker state and adaptive timeouts for each backend route, and replica health"""
+    routes = {route: breaker.stats() for route, breaker in backend_breakers.items()}
+    replicas = [replica.stats() for replica in backend_pool.replicas]
+    healthy = all(route["state"] == "closed" for route in routes.values()) and all(replica["healthy"] for replica in replicas)
+    return {
+        "status": "ok" if healthy else "degraded",
+        "routes": routes,
+        "replicas": replicas
+    }
+
 @app.get("/api/v1/user")
 async def get_user_info(user: UserInDB = Depends(get_current_user)):
     """Get current user info"""
     return {"email": user.email, "name": user.name, "picture": user.picture}
 
+@app.post("/api/v1/upload-url")
+async def create_upload_url(request: UploadUrlRequest, user: UserInDB = Depends(get_current_user)):
+    """Create a short-lived presigned POST so the browser can upload an image straight to S3"""
+    if not s3_client:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="S3 storage is not configured"
+        )
+    
+    # Browser-direct uploads would skip preprocessing, so send clients through the server instead
+    if IMAGE_PROCESSING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Browser-direct uploads are disabled while image processing is enabled"
+        )
+    
+    if not request.content_type.startswith('image/'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="File must be an image"
+        )
+    
+    if request.size is not None and request.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds the {UPLOAD_MAX_BYTES} byte upload limit"
+        )
+    
+    # Same key scheme as /api/v1/upload-image
+    file_extension = os.path.splitext(request.filename)[1]
+    unique_filename = f"{user.email}/{uuid.uuid4()}{file_extension}"
+    
+    # S3 enforces the content type and size limits when the browser posts the file
+    try:
+        presigned_post = s3_client.generate_presigned_post(
+            Bucket=S3_BUCKET_NAME,
+            Key=unique_filename,
+            Fields={"Content-Type": request.content_type, "acl": "public-read"},
+            Conditions=[
+                {"Content-Type": request.content_type},
+                {"acl": "public-read"},
+                ["content-length-range", 1, UPLOAD_MAX_BYTES]
+            ],
+            ExpiresIn=PRESIGNED_UPLOAD_EXPIRY
+        )
+    except Exception as e:
+        logger.error(f"Error creating presigned upload: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to create upload URL"
+        )
+    
+    logger.info(f"Created presigned upload for: {unique_filename}")
+    return {
+        "url": presigned_post["url"],
+        "fields": presigned_post["fields"],
+        "key": unique_filename,
+        "expires_in": PRESIGNED_UPLOAD_EXPIRY
+    }
+
+@app.post("/api/v1/upload-complete")
+async def confirm_upload(request: UploadCompleteRequest, user: UserInDB = Depends(get_current_user)):
+    """Confirm a browser-direct upload and return its public URL"""
+    if not s3_client:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="S3 storage is not configured"
+        )
+    
+    if not request.key.startswith(f"{user.email}/"):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Unauthorized to confirm this upload"
+        )
+    
+    try:
+        with observe_upstream("s3", "head_object"):
+            head = await run_in_threadpool(s3_client.head_object, Bucket=S3_BUCKET_NAME, Key=request.key)
+    except Exception as e:
+        logger.error(f"Uploaded object not found {request.key}: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Uploaded image not found"
+        )
+    
+    if not head.get("ContentType", "").startswith('image/'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="File must be an image"
+        )
+    
+    image_url = s3_object_url(request.key)
+    logger.info(f"Direct-to-S3 upload confirmed ({head.get('ContentLength')} bytes): {image_url}")
+    return {"image_url": image_url}
+
 @app.post("/api/v1/upload-image")
 async def upload_image(
     file: UploadFile = File(..., alias="image"),
@@ -289,41 +2845,29 @@ async def upload_image(
                 detail="File must be an image"
             )
         
-        # Generate a unique file name
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{user.email}/{uuid.uuid4()}{file_extension}"
-        logger.info(f"Generated unique filename: {unique_filename}")
-        
-        # Read file contents
-        file_contents = await file.read()
-        file_size = len(file_contents)
-        logger.info(f"Read {file_size} bytes from image file")
-        
         # For testing: If S3 is not configured, return a dummy URL
         if os.getenv("ENVIRONMENT") == "development" and not AWS_ACCESS_KEY:
             logger.info("Development mode: returning dummy URL")
-            return {"image_url": f"https://example.com/dummy/{unique_filename}"}
+            dummy_filename = f"{user.email}/{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
+            return {"image_url": f"https://example.com/dummy/{dummy_filename}"}
         
-        # Upload to S3
+        # Stream the spooled upload (or its preprocessed version) to S3
         logger.info(f"Uploading to S3 bucket: {S3_BUCKET_NAME}")
         try:
-            s3_client.put_object(
-                Bucket=S3_BUCKET_NAME,
-                Key=unique_filename,
-                Body=file_contents,
-                ContentType=content_type,
-                ACL='public-read'  # Make the file publicly accessible
-            )
-            
-            # Generate the URL with clean region
-            region = S3_REGION.strip('%')  # Remove any trailing % character
-            image_url = f"https://{S3_BUCKET_NAME}.s3.{region}.amazonaws.com/{unique_filename}"
+            unique_filename, file_size = await store_image(file, user.email, public=True)
+            image_url = s3_object_url(unique_filename)
             
             # Log success
-            logger.info(f"Image uploaded successfully: {image_url}")
+            logger.info(f"Image uploaded successfully ({file_size} bytes): {image_url}")
             
             return {"image_url": image_url}
             
+        except UploadTooLarge as size_error:
+            logger.error(f"Upload rejected: {str(size_error)}")
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=str(size_error)
+            )
         except Exception as s3_error:
             logger.error(f"S3 upload error: {str(s3_error)}")
             logger.exception("S3 exception details:")
@@ -332,6 +2876,8 @@ async def upload_image(
                 detail=f"Failed to upload image to S3: {str(s3_error)}"
             )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading image: {str(e)}")
         logger.exception("Full exception details:")
@@ -341,62 +2887,151 @@ async def upload_image(
         )
 
 @app.post("/api/v1/chat")
-async def proxy_chat_api(request: Request, user: Optional[UserInDB] = Depends(get_user_from_token)):
+async def proxy_chat_api(request: Request, user: UserInDB = Depends(get_current_user)):
     # Get the request body
     try:
         body = await request.json()
         message = body.get('message', '')
         image_link = body.get('image_link', None)
-        logger.info(f"Received chat request: {message[:50]}...")
+        # Lets the client stop this generation later; it isn't forwarded to the backend
+        request_id = str(body.pop("request_id", None) or uuid.uuid4().hex)
+        logger.info("Received chat request", extra={"message_length": len(message), "has_image": bool(image_link)})
         
-        if image_link:
-            logger.info(f"Image included in request: {image_link}")
+        # Add user email
+        body["email_id"] = user.email
+        params = {"email_id": user.email}
         
-        # Using a fixed timeout of 90 seconds for all requests
-        timeout = 180.0
-        logger.info(f"Using timeout: {timeout}s for all requests")
+        # The new turn changes this user's session list and conversation history
+        async def invalidate_cached_reads():
+            forget_backend_reads(user.email)
+            await read_cache.invalidate_conversation(user.email, body.get("conversation_id"))
         
-        # Add user email if authenticated
-        if user:
-            body["email_id"] = user.email
+        # Store the finished turn locally, or mark its session for a re-read when the turn was cut short
+        def record_turn(reply: Optional[dict]):
+            session_id = (reply or {}).get("conversation_id") or body.get("conversation_id")
+            if reply is None:
+                message_store.mark_stale(user.email, session_id)
+            else:
+                message_store.record_turn(
+                    user.email, session_id, message, reply.get("text_content") or "",
+                    new_session=not body.get("conversation_id")
+                )
         
-        # Forward the request to the backend API
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    f"{BACKEND_API_URL}/api/v1/chat?email_id={user.email}",
-                    json=body,
-                    headers={"Content-Type": "application/json"},
-                    timeout=timeout  # Fixed 90-second timeout
+        wants_stream = CHAT_STREAMING and "text/event-stream" in request.headers.get("accept", "")
+        # Adaptive, so report the timeout that actually applies to this call
+        timeout = backend_breakers["chat"].read_timeout("chat_stream" if wants_stream else "chat")
+        
+        # Admission control: per-user rate and concurrency limits, bounded wait for a backend slot
+        client_key = user.email
+        try:
+            release_admission = await chat_admission.acquire(client_key)
+        except AdmissionRejected as rejected:
+            logger.warning(f"Chat request rejected: {rejected.detail}", extra={"status": rejected.status_code})
+            return JSONResponse(
+                content={"error": rejected.detail},
+                status_code=rejected.status_code,
+                headers={"Retry-After": str(rejected.retry_after)}
+            )
+        
+        # Streamed replies hold their admission until the stream ends
+        transcript = ReplyTranscript()
+        async def finish_stream():
+            chat_stops.unregister(client_key, request_id)
+            await release_admission()
+            record_turn(transcript.reply())
+            await invalidate_cached_reads()
+        
+        # Forward the request to the backend API over the shared connection pool, giving up
+        # as soon as the client disconnects or stops the generation
+        stopped = chat_stops.register(client_key, request_id)
+        streaming = False
+        try:
+            if wants_stream:
+                response = await run_until_stopped(
+                    backend_stream(
+                        "chat",
+                        body,
+                        params=params,
+                        headers={"Accept": "text/event-stream, application/x-ndjson, application/json"},
+                        affinity=body.get("conversation_id")
+                    ),
+                    request,
+                    stopped
                 )
+                if response.headers.get("content-type", "").startswith(STREAM_MEDIA_TYPES):
+                    logger.info("Streaming backend response to client")
+                    streaming = True
+                    return StreamingResponse(
+                        relay_backend_stream("chat", response, on_close=finish_stream, stopped=stopped, transcript=transcript),
+                        status_code=response.status_code,
+                        media_type="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Chat-Request-Id": request_id},
+                        background=BackgroundTask(release_admission)
+                    )
                 
+                # Backend doesn't stream, fall back to the buffered JSON response
+                try:
+                    await run_until_stopped(response.aread(), request, stopped)
+                finally:
+                    await close_backend_stream(response)
+            else:
+                response = await run_until_stopped(
+                    backend_post("chat", body, params=params, affinity=body.get("conversation_id")),
+                    request,
+                    stopped
+                )
+            try:
                 # Get the response data
                 response_data = response.json()
-                logger.info(f"Response type: {response_data.get('type')}")
-                
-                # Log the full response for debugging
-                if 'text_content' in response_data:
-                    logger.info(f"Response text content: {response_data['text_content']}")
-                if 'image_content' in response_data:
-                    logger.info(f"Response has image_content: {'Yes' if response_data['image_content'] else 'No'}")
-                
-                # Return the backend API response
-                return JSONResponse(
-                    content=response_data,
-                    status_code=response.status_code
-                )
-            except httpx.TimeoutException:
-                logger.error(f"Request timed out after {timeout} seconds")
-                return JSONResponse(
-                    content={"error": f"Request timed out after {timeout} seconds"},
-                    status_code=504
-                )
-            except Exception as e:
-                logger.error(f"Error in proxy request: {str(e)}")
-                return JSONResponse(
-                    content={"error": f"Failed to process request: {str(e)}"},
-                    status_code=500
-                )
+                if response.status_code == 200:
+                    record_turn(response_data)
+            finally:
+                await invalidate_cached_reads()
+            # Log a summary only; reply text can be long and may contain user data
+            logger.info("Chat response", extra={
+                "status": response.status_code,
+                "response_type": response_data.get("type"),
+                "text_length": len(response_data.get("text_content") or ""),
+                "has_image": bool(response_data.get("image_content"))
+            })
+            
+            # Return the backend API response
+            return JSONResponse(
+                content=response_data,
+                status_code=response.status_code,
+                headers={"X-Chat-Request-Id": request_id}
+            )
+        except ChatStopped as e:
+            logger.info(f"Chat request abandoned: client {e.reason}")
+            # The backend may have saved part of the turn before it was cut off
+            record_turn(None)
+            await invalidate_cached_reads()
+            # 499 is the de facto "client closed request" status; usually nobody is left to read it
+            return JSONResponse(content={"error": "Generation stopped"}, status_code=499)
+        except BackendUnavailable as e:
+            logger.warning(f"Chat request failed fast: {str(e)}")
+            return JSONResponse(
+                content={"error": "The model backend is temporarily unavailable, please try again shortly"},
+                status_code=503,
+                headers={"Retry-After": str(e.retry_after)}
+            )
+        except httpx.TimeoutException:
+            logger.error(f"Request timed out after {timeout:.0f} seconds")
+            record_turn(None)
+            return JSONResponse(
+                content={"error": f"Request timed out after {timeout:.0f} seconds"},
+                status_code=504
+            )
+        except Exception as e:
+            logger.error(f"Error in proxy request: {str(e)}")
+            return JSONResponse(
+                content={"error": f"Failed to process request: {str(e)}"},
+                status_code=500
+            )
+        finally:
+            if not streaming:
+                chat_stops.unregister(client_key, request_id)
+                await release_admission()
     except Exception as e:
         logger.error(f"Error parsing request: {str(e)}")
         return JSONResponse(
@@ -404,10 +3039,357 @@ async def proxy_chat_api(request: Request, user: Optional[UserInDB] = Depends(ge
             status_code=400
         )
 
+@app.post("/api/v1/chat/stop")
+async def stop_chat(stop: ChatStopRequest, user: UserInDB = Depends(get_current_user)):
+    """Stop one of the caller's in-flight chat requests, closing its backend call"""
+    # Keyed by the caller, so a request id on its own can't stop someone else's generation
+    result = await chat_stops.stop(user.email, stop.request_id)
+    logger.info(f"Chat stop requested: {result}")
+    return {"request_id": stop.request_id, "status": result}
+
+# WebSocket chat transport: one authenticated connection carries the replies for any number of conversations
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+# How long a reply keeps running without a connected client, waiting for it to reconnect and resume
+WS_RESUME_TIMEOUT = float(os.getenv("WS_RESUME_TIMEOUT", "30"))
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "256"))
+# Origins besides the app's own host allowed to open the socket, e.g. "https://chat.example.com"
+WS_ALLOWED_ORIGINS = {origin.strip().rstrip("/") for origin in os.getenv("WS_ALLOWED_ORIGINS", "").split(",") if origin.strip()}
+WS_CLOSE_UNAUTHORIZED = 4401
+WS_CLOSE_IDLE = 4408
+
+class ChatGeneration:
+    """A chat reply sent over WebSocket; its frames are kept so a client that reconnects can resume it"""
+
+    def __init__(self, client_key: str, request_id: str, stopped: asyncio.Event):
+        self.client_key = client_key
+        self.request_id = request_id
+        self.stopped = stopped
+        self.frames = []
+        self.finished = False
+        self.followers = 0
+        self.updated = asyncio.Event()
+        self.task = None
+
+    def publish(self, frame: dict, final: bool = False):
+        self.frames.append({**frame, "id": self.request_id, "seq": len(self.frames) + 1})
+        self.finished = self.finished or final
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    async def follow(self, after: int, send: Callable[[dict], Awaitable]):
+        """Send the frames after seq `after`, then new ones as they are published, until the reply is finished"""
+        sent = max(0, after)
+        while True:
+            updated = self.updated
+            while sent < len(self.frames):
+                await send(self.frames[sent])
+                sent += 1
+            if self.finished:
+                return
+            await updated.wait()
+
+class ChatGenerations:
+    """WebSocket replies on this worker, keyed by client and request id"""
+
+    def __init__(self):
+        self.generations = {}
+        self.connections = 0
+        self.counters = {"started": 0, "resumed": 0, "resume_misses": 0, "abandoned": 0}
+
+    def get(self, client_key: str, request_id: str):
+        return self.generations.get((client_key, request_id))
+
+    def start(self, client_key: str, request_id: str, run: Callable[[ChatGeneration], Awaitable]):
+        generation = ChatGeneration(client_key, request_id, chat_stops.register(client_key, request_id))
+        self.generations[(client_key, request_id)] = generation
+        self.counters["started"] += 1
+        generation.task = asyncio.create_task(run(generation))
+        generation.task.add_done_callback(lambda task: self.finished(generation))
+        return generation
+
+    def finished(self, generation: ChatGeneration):
+        if not generation.finished:
+            generation.publish({"type": "error", "status": 500, "error": "Reply ended unexpectedly"}, final=True)
+        # Kept for a while so a client that dropped right at the end still gets the last frames
+        asyncio.get_running_loop().call_later(WS_RESUME_TIMEOUT, self.forget, generation)
+
+    def forget(self, generation: ChatGeneration):
+        key = (generation.client_key, generation.request_id)
+        if self.generations.get(key) is generation:
+            del self.generations[key]
+
+    async def follow(self, generation: ChatGeneration, after: int, send: Callable[[dict], Awaitable]):
+        generation.followers += 1
+        try:
+            await generation.follow(after, send)
+        finally:
+            generation.followers -= 1
+            if generation.followers == 0 and not generation.finished:
+                asyncio.get_running_loop().call_later(WS_RESUME_TIMEOUT, self.abandon, generation)
+
+    def abandon(self, generation: ChatGeneration):
+        """Stop a reply whose client didn't come back"""
+        if generation.followers == 0 and not generation.finished and not generation.stopped.is_set():
+            self.counters["abandoned"] += 1
+            logger.info("No client resumed the reply, stopping it")
+            generation.stopped.set()
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "replies": len(self.generations),
+            "running": sum(1 for generation in self.generations.values() if not generation.finished),
+            **self.counters
+        }
+
+chat_generations = ChatGenerations()
+
+async def backend_stream_events(response: httpx.Response):
+    """Parse a streaming chat response into (event, data) pairs, from SSE or newline-delimited JSON"""
+    if response.headers.get("content-type", "").startswith("application/x-ndjson"):
+        async for line in response.aiter_lines():
+            if line.strip():
+                yield "message", line
+        return
+    event, data = "message", []
+    async for line in response.aiter_lines():
+        if not line:
+            # A blank line ends the event
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[6:] if line.startswith("data: ") else line[5:])
+    if data:
+        yield event, "\n".join(data)
+
+def backend_error_frame(response: httpx.Response):
+    try:
+        detail = response.json().get("error")
+    except Exception:
+        detail = None
+    return {"type": "error", "status": response.status_code, "error": detail or f"Backend returned {response.status_code}"}
+
+async def stream_chat_generation(generation: ChatGeneration, body: dict, email: str):
+    """Run one WebSocket chat request against the backend, publishing its reply as frames"""
+    reply = None
+    try:
+        release_admission = await chat_admission.acquire(generation.client_key)
+    except AdmissionRejected as rejected:
+        logger.warning(f"Chat request rejected: {rejected.detail}", extra={"status": rejected.status_code})
+        generation.publish({
+            "type": "error",
+            "status": rejected.status_code,
+            "error": rejected.detail,
+            "retry_after": rejected.retry_after
+        }, final=True)
+        chat_stops.unregister(generation.client_key, generation.request_id)
+        return
+    
+    try:
+        response = await run_until_stopped(
+            backend_stream(
+                "chat",
+                body,
+                params={"email_id": email},
+                headers={"Accept": "text/event-stream, application/x-ndjson, application/json"},
+                affinity=body.get("conversation_id")
+            ),
+            None,
+            generation.stopped
+        )
+        try:
+            if not response.headers.get("content-type", "").startswith(STREAM_MEDIA_TYPES):
+                # Backend doesn't stream, send the buffered JSON response as one frame
+                await run_until_stopped(response.aread(), None, generation.stopped)
+                if response.status_code >= 400:
+                    generation.publish(backend_error_frame(response), final=True)
+                else:
+                    reply = response.json()
+                    generation.publish({"type": "done", "response": reply}, final=True)
+                return
+            
+            transcript = ReplyTranscript()
+            try:
+                async for event, data in iterate_until(backend_stream_events(response), generation.stopped):
+                    delta = transcript.add(event, data)
+                    if transcript.error:
+                        generation.publish({"type": "error", "status": 502, "error": transcript.error}, final=True)
+                        return
+                    if delta is not None:
+                        generation.publish({"type": "delta", "delta": delta})
+            except httpx.HTTPError as e:
+                record_stream_error("chat", response, e)
+                generation.publish({"type": "error", "status": 502, "error": "Backend stream interrupted"}, final=True)
+                return
+            if generation.stopped.is_set():
+                backend_request_stats["cancelled"] += 1
+                raise ChatStopped("stopped")
+            transcript.complete = True
+            reply = transcript.reply()
+            generation.publish({"type": "done", "response": reply}, final=True)
+        finally:
+            await close_backend_stream(response)
+    except ChatStopped:
+        logger.info("Generation stopped, closed backend call")
+        generation.publish({"type": "stopped"}, final=True)
+    except BackendUnavailable as e:
+        logger.warning(f"Chat request failed fast: {str(e)}")
+        generation.publish({
+            "type": "error",
+            "status": 503,
+            "error": "The model backend is temporarily unavailable, please try again shortly",
+            "retry_after": e.retry_after
+        }, final=True)
+    except httpx.TimeoutException:
+        timeout = backend_breakers["chat"].read_timeout("chat_stream")
+        logger.error(f"Request timed out after {timeout:.0f} seconds")
+        generation.publish({"type": "error", "status": 504, "error": f"Request timed out after {timeout:.0f} seconds"}, final=True)
+    except Exception as e:
+        logger.error(f"Error in WebSocket chat request: {str(e)}")
+        generation.publish({"type": "error", "status": 500, "error": f"Failed to process request: {str(e)}"}, final=True)
+    finally:
+        chat_stops.unregister(generation.client_key, generation.request_id)
+        await release_admission()
+        # Store the finished turn locally; one that failed or was cut short may be partly saved by the backend
+        session_id = (reply or {}).get("conversation_id") or body.get("conversation_id")
+        if reply is not None:
+            message_store.record_turn(
+                email, session_id, body.get("message", ""), reply.get("text_content") or "",
+                new_session=not body.get("conversation_id")
+            )
+        else:
+            message_store.mark_stale(email, session_id)
+        # The new turn changes this user's session list and conversation history
+        forget_backend_reads(email)
+        await read_cache.invalidate_conversation(email, body.get("conversation_id"))
+
+def websocket_origin_allowed(websocket: WebSocket):
+    """Browsers send cookies with cross-site WebSocket handshakes, so only our own pages may connect"""
+    origin = websocket.headers.get("origin")
+    if not origin:
+        # Not a browser
+        return True
+    if origin.rstrip("/") in WS_ALLOWED_ORIGINS:
+        return True
+    return urlparse(origin).netloc == websocket.headers.get("host")
+
+@app.websocket("/api/v1/chat/ws")
+async def chat_websocket(websocket: WebSocket, token: Optional[str] = Cookie(None)):
+    """Chat over one WebSocket: authenticated once, with replies for several conversations interleaved"""
+    if not websocket_origin_allowed(websocket):
+        logger.warning(f"Rejected WebSocket from origin {websocket.headers.get('origin')}")
+        await websocket.close()
+        return
+    user = await get_user_from_token(token)
+    await websocket.accept()
+    if not user:
+        await websocket.close(code=WS_CLOSE_UNAUTHORIZED)
+        return
+    expires = jwt.get_unverified_claims(token).get("exp")
+    client_key = user.email
+    
+    # Replies are sent from their own tasks, so every frame goes through one writer
+    outbox = asyncio.Queue(WS_SEND_QUEUE)
+    followers = {}
+    
+    async def write_frames():
+        try:
+            while True:
+                frame = await outbox.get()
+                await websocket.send_text(json.dumps(frame))
+        except Exception:
+            # The socket is gone; the receive loop notices and cleans up
+            pass
+    
+    def follow(generation: ChatGeneration, after: int):
+        previous = followers.pop(generation.request_id, None)
+        if previous:
+            previous.cancel()
+        task = asyncio.create_task(chat_generations.follow(generation, after, outbox.put))
+        followers[generation.request_id] = task
+        task.add_done_callback(lambda done: followers.pop(generation.request_id, None) if followers.get(generation.request_id) is done else None)
+    
+    async def handle(frame: dict):
+        kind = frame.get("type")
+        request_id = str(frame.get("id") or "")[:64]
+        if kind == "ping":
+            await outbox.put({"type": "pong"})
+        elif kind == "chat":
+            message = frame.get("message")
+            if not request_id or not isinstance(message, str) or not message:
+                await outbox.put({"type": "error", "id": request_id or None, "status": 400, "error": "A chat frame needs an id and a message"})
+                return
+            if chat_generations.get(client_key, request_id):
+                await outbox.put({"type": "error", "id": request_id, "status": 409, "error": "Duplicate request id, resume it instead"})
+                return
+            body = {key: value for key, value in frame.items() if key not in ("type", "id")}
+            body["email_id"] = user.email
+            logger.info("Received chat request", extra={"message_length": len(message), "has_image": bool(body.get("image_link")), "transport": "websocket"})
+            follow(chat_generations.start(client_key, request_id, lambda generation: stream_chat_generation(generation, body, user.email)), 0)
+        elif kind == "resume":
+            after = frame.get("after", 0)
+            if after is None:
+                after = 0
+            if isinstance(after, str) and after.isdigit():
+                after = int(after)
+            if not isinstance(after, int) or isinstance(after, bool) or after < 0:
+                await outbox.put({"type": "error", "id": request_id or None, "status": 400, "error": "after must be a non-negative sequence number"})
+                return
+            generation = chat_generations.get(client_key, request_id)
+            if not generation:
+                chat_generations.counters["resume_misses"] += 1
+                await outbox.put({"type": "error", "id": request_id, "status": 404, "error": "Unknown or expired reply"})
+                return
+            chat_generations.counters["resumed"] += 1
+            follow(generation, after)
+        elif kind == "stop":
+            await chat_stops.stop(client_key, request_id)
+        else:
+            await outbox.put({"type": "error", "status": 400, "error": f"Unknown frame type: {kind}"})
+    
+    chat_generations.connections += 1
+    writer = asyncio.create_task(write_frames())
+    await outbox.put({"type": "ready", "heartbeat": WS_HEARTBEAT_INTERVAL, "resume_timeout": WS_RESUME_TIMEOUT})
+    try:
+        while True:
+            try:
+                # Clients ping every WS_HEARTBEAT_INTERVAL, so silence means the connection is dead
+                text = await asyncio.wait_for(websocket.receive_text(), WS_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                await websocket.close(code=WS_CLOSE_IDLE)
+                break
+            if expires and time.time() >= expires:
+                await websocket.close(code=WS_CLOSE_UNAUTHORIZED)
+                break
+            try:
+                frame = json.loads(text)
+            except ValueError:
+                frame = None
+            if not isinstance(frame, dict):
+                await outbox.put({"type": "error", "status": 400, "error": "Frames must be JSON objects"})
+                continue
+            await handle(frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        chat_generations.connections -= 1
+        writer.cancel()
+        # Replies keep running for WS_RESUME_TIMEOUT in case the client reconnects
+        for task in list(followers.values()):
+            task.cancel()
+
 # New endpoints for session management
 
 @app.post("/api/v1/sessions")
-async def get_sessions(request: EmailRequest, user: Optional[UserInDB] = Depends(get_user_from_token)):
+async def get_sessions(
+    request: EmailRequest,
+    user: Optional[UserInDB] = Depends(get_user_from_token),
+    if_none_match: Optional[str] = Header(None)
+):
     """Get all chat sessions for an email"""
     try:
         # Verify user is authorized to access this email's sessions
@@ -417,24 +3399,36 @@ async def get_sessions(request: EmailRequest, user: Optional[UserInDB] = Depends
                 status_code=403
             )
             
-        logger.info(f"Getting sessions for email: {request.email_id}")
+        logger.info("Getting sessions", extra={"email": request.email_id})
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BACKEND_API_URL}/api/v1/sessions",
-                json={"email_id": request.email_id},
-                headers={"Content-Type": "application/json"},
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
+        cached = await read_cache.get_sessions(request.email_id)
+        if cached:
+            return etag_response(cached, if_none_match)
+        
+        async def fetch_sessions():
+            fill = await read_cache.sessions_fill(request.email_id)
+            # From the local message store when it holds this user's sessions, otherwise from the backend
+            sessions_data = await message_store.sessions(request.email_id)
+            if sessions_data is None:
+                response = await backend_post("sessions", {"email_id": request.email_id})
+                if response.status_code != 200:
+                    return None
                 sessions_data = response.json()
-                print(f"Sessions data: {sessions_data}")
-                return sessions_data
-            else:
-                # For development - if backend isn't available, return mock data
-                logger.warning(f"Backend API not available, returning mock session data")
+                message_store.backfill_sessions(request.email_id, sessions_data)
+            logger.debug("Sessions returned", extra={"count": len(sessions_data.get("sessions") or [])})
+            return await read_cache.store(fill, sessions_data)
+        
+        # Concurrent loads of the same list (several tabs, repeated clicks) share one backend call
+        entry = await backend_reads.do(("sessions", request.email_id), fetch_sessions)
+        
+        if entry:
+            return etag_response(entry, if_none_match)
+        else:
+            # For development - if backend isn't available, return mock data
+            logger.warning(f"Backend API not available, returning mock session data")
 
+    except BackendUnavailable as e:
+        return backend_unavailable_response(e)
     except Exception as e:
         logger.error(f"Error getting sessions: {str(e)}")
         return JSONResponse(
@@ -442,8 +3436,74 @@ async def get_sessions(request: EmailRequest, user: Optional[UserInDB] = Depends
             status_code=500
         )
 
+async def load_history_entry(
+    session_id: str,
+    email_id: Optional[str],
+    cache_email: Optional[str],
+    limit: Optional[int],
+    before: Optional[str]
+):
+    """One conversation's history, or a page of it, as an {"etag", "data"} entry; None when the backend has none"""
+    backend_pages = bool(limit) and BACKEND_PAGINATES_HISTORY
+    # Reject a malformed cursor up front, whether or not the store is going to answer
+    if before and before.startswith(LOCAL_CURSOR_PREFIX):
+        parse_local_cursor(before)
+    elif before and not backend_pages and not before.isdigit():
+        raise InvalidHistoryCursor("Malformed history cursor")
+    
+    def page(entry):
+        # Pages are sliced from the cached full history
+        if limit and not backend_pages:
+            data = paginate_history(entry["data"], limit, before)
+            return {"etag": make_etag(data), "data": data}
+        return entry
+    
+    # The local message store answers once it holds the whole session
+    if cache_email:
+        local = await message_store.history(cache_email, session_id, limit, before)
+        if local is not None:
+            return {"etag": make_etag(local), "data": local}
+    # Store cursors mean nothing to the backend's copy, so the client has to start again from the newest page
+    if before and before.startswith(LOCAL_CURSOR_PREFIX):
+        raise InvalidHistoryCursor("History cursor has expired, reload the conversation", status_code=409)
+    
+    if cache_email and not backend_pages:
+        cached = await read_cache.get_history(cache_email, session_id)
+        if cached:
+            return page(cached)
+    
+    request_data = {"session_id": session_id}
+    if email_id:
+        request_data["email_id"] = email_id
+    if backend_pages:
+        request_data["limit"] = limit
+        if before:
+            request_data["before"] = before
+    
+    async def fetch_history():
+        fetched_at = time.time()
+        fill = await read_cache.history_fill(cache_email, session_id) if cache_email and not backend_pages else None
+        response = await backend_post("conversation-history", request_data, affinity=session_id)
+        if response.status_code != 200:
+            return None
+        history_data = response.json()
+        if cache_email and not backend_pages:
+            # A full history, so the local store can take over this session from here
+            message_store.backfill_history(cache_email, session_id, history_data, fetched_at)
+            return await read_cache.store(fill, history_data)
+        return {"etag": make_etag(history_data), "data": history_data}
+    
+    # Concurrent identical loads share one backend call
+    flight_key = ("conversation-history", cache_email, json.dumps(request_data, sort_keys=True))
+    entry = await backend_reads.do(flight_key, fetch_history)
+    return page(entry) if entry else None
+
 @app.post("/api/v1/conversation-history")
-async def get_conversation_history(request: SessionRequest, user: Optional[UserInDB] = Depends(get_user_from_token)):
+async def get_conversation_history(
+    request: SessionRequest,
+    user: Optional[UserInDB] = Depends(get_user_from_token),
+    if_none_match: Optional[str] = Header(None)
+):
     """Get conversation history for a session"""
     try:
         # Verify user is authorized to access this session
@@ -453,27 +3513,23 @@ async def get_conversation_history(request: SessionRequest, user: Optional[UserI
                 status_code=403
             )
             
-        logger.info(f"Getting conversation history for session: {request.session_id}")
+        logger.info("Getting conversation history", extra={"session_id": request.session_id})
         
-        # If not in MongoDB, try backend API
-        request_data = {"session_id": request.session_id}
-        if request.email_id:
-            request_data["email_id"] = request.email_id
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BACKEND_API_URL}/api/v1/conversation-history",
-                json=request_data,
-                headers={"Content-Type": "application/json"},
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                history_data = response.json()
-                return history_data
-            else:
-                # For development - if backend isn't available, return mock data
-                logger.warning(f"Backend API not available, returning mock conversation data")
+        limit = min(max(request.limit, 1), HISTORY_PAGE_MAX) if request.limit else None
+        # Histories are cached per user, so anonymous lookups always go to the backend
+        cache_email = request.email_id or (user.email if user else None)
+        entry = await load_history_entry(request.session_id, request.email_id, cache_email, limit, request.before)
+        
+        if entry:
+            return etag_response(entry, if_none_match)
+        else:
+            # For development - if backend isn't available, return mock data
+            logger.warning(f"Backend API not available, returning mock conversation data")
                 
+    except InvalidHistoryCursor as e:
+        return JSONResponse(content={"detail": e.detail}, status_code=e.status_code)
+    except BackendUnavailable as e:
+        return backend_unavailable_response(e)
     except Exception as e:
         logger.error(f"Error getting conversation history: {str(e)}")
         return JSONResponse(
@@ -499,23 +3555,29 @@ async def clear_conversation(request: ClearConversationRequest, user: Optional[U
         if request.email_id:
             request_data["email_id"] = request.email_id
             
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BACKEND_API_URL}/api/v1/clear-conversation",
-                json=request_data,
-                headers={"Content-Type": "application/json"},
-                timeout=30.0
-            )
-            
+        response = await backend_post("clear-conversation", request_data, affinity=request.conversation_id)
+        
+        cache_email = request.email_id or (user.email if user else None)
+        if cache_email:
             if response.status_code == 200:
-                return response.json()
+                await message_store.clear(cache_email, request.conversation_id)
+            forget_backend_reads(cache_email)
+            if request.conversation_id:
+                await read_cache.invalidate_conversation(cache_email, request.conversation_id)
             else:
-                # If backend API is not available, return success anyway
-                logger.warning(f"Backend API not available for clearing conversation, but MongoDB was cleared")
-                return {
-                    "type": "info",
-                    "text_content": f"Conversation history cleared successfully."
-                }
+                await read_cache.invalidate_user(cache_email)
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # If backend API is not available, return success anyway
+            logger.warning(f"Backend API not available for clearing conversation, but MongoDB was cleared")
+            return {
+                "type": "info",
+                "text_content": f"Conversation history cleared successfully."
+            }
+    except BackendUnavailable as e:
+        return backend_unavailable_response(e)
     except Exception as e:
         logger.error(f"Error clearing conversation: {str(e)}")
         return JSONResponse(
@@ -523,6 +3585,88 @@ async def clear_conversation(request: ClearConversationRequest, user: Optional[U
             status_code=500
         )
 
+# Batch conversation operations: items fan out to the backend concurrently, bounded per request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+async def run_batch(items: List[str], key: str, operation: Callable[[str], Awaitable[dict]]):
+    """Run operation for each item, at most BATCH_CONCURRENCY at a time, collecting a result per item"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_one(item):
+        async with semaphore:
+            try:
+                result = await operation(item)
+            except BackendUnavailable as e:
+                result = {"status": "error", "status_code": 503, "error": "Backend is temporarily unavailable", "retry_after": e.retry_after}
+            except Exception as e:
+                logger.error(f"Batch item failed: {str(e)}", extra={key: item})
+                result = {"status": "error", "status_code": 500, "error": str(e)}
+        return {key: item, **result}
+    
+    # Duplicates would only repeat the same backend call
+    results = await asyncio.gather(*(run_one(item) for item in dict.fromkeys(items)))
+    succeeded = sum(1 for result in results if result["status"] == "ok")
+    return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
+
+def batch_too_large(items: List[str]):
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            content={"detail": f"At most {BATCH_MAX_ITEMS} items per batch"},
+            status_code=400
+        )
+    return None
+
+@app.post("/api/v1/clear-conversation/batch")
+async def clear_conversations_batch(request: BatchClearRequest, user: UserInDB = Depends(get_current_user)):
+    """Clear several conversations in one request, reporting the outcome of each"""
+    if request.email_id and user.email != request.email_id:
+        return JSONResponse(
+            content={"detail": "Unauthorized to clear these conversations"},
+            status_code=403
+        )
+    too_large = batch_too_large(request.conversation_ids)
+    if too_large:
+        return too_large
+    
+    async def clear_one(conversation_id):
+        request_data = {"conversation_id": conversation_id, "email_id": user.email}
+        response = await backend_post("clear-conversation", request_data, affinity=conversation_id)
+        if response.status_code == 200:
+            await message_store.clear(user.email, conversation_id)
+        # Reads that started while this delete was running may still return the conversation
+        forget_backend_reads(user.email)
+        await read_cache.invalidate_conversation(user.email, conversation_id)
+        if response.status_code == 200:
+            return {"status": "ok"}
+        return {"status": "error", "status_code": response.status_code, "error": f"Backend returned {response.status_code}"}
+    
+    logger.info("Clearing conversations", extra={"count": len(request.conversation_ids)})
+    return await run_batch(request.conversation_ids, "conversation_id", clear_one)
+
+@app.post("/api/v1/conversation-history/batch")
+async def get_conversation_histories(request: BatchHistoryRequest, user: UserInDB = Depends(get_current_user)):
+    """Get the histories of several sessions in one request, reporting the outcome of each"""
+    if request.email_id and user.email != request.email_id:
+        return JSONResponse(
+            content={"detail": "Unauthorized to access these conversations"},
+            status_code=403
+        )
+    too_large = batch_too_large(request.session_ids)
+    if too_large:
+        return too_large
+    
+    limit = min(max(request.limit, 1), HISTORY_PAGE_MAX) if request.limit else None
+    
+    async def load_one(session_id):
+        entry = await load_history_entry(session_id, user.email, user.email, limit, None)
+        if entry:
+            return {"status": "ok", "history": entry["data"]}
+        return {"status": "error", "status_code": 502, "error": "Backend returned no history"}
+    
+    logger.info("Getting conversation histories", extra={"count": len(request.session_ids)})
+    return await run_batch(request.session_ids, "session_id", load_one)
+
 # Add a direct upload endpoint for testing (no authentication)
 @app.post("/api/v1/direct-upload")
 async def direct_upload(
@@ -544,11 +3688,6 @@ async def direct_upload(
                 detail="File must be an image"
             )
         
-        # Read file contents
-        file_contents = await file.read()
-        file_size = len(file_contents)
-        logger.info(f"Read {file_size} bytes from image file")
-        
         # Check if S3 client is configured
         if not s3_client:
             logger.error("S3 client not configured")
@@ -558,30 +3697,25 @@ async def direct_upload(
             logger.info(f"S3 not configured, generated dummy URL: {dummy_url}")
             return {"image_url": dummy_url}
         
-        # Generate a unique file name for ai-chats uploads
         file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"ai-chats/{uuid.uuid4()}{file_extension}"
-        logger.info(f"Generated unique filename: {unique_filename}")
         
-        # Upload to S3
+        # Stream the spooled upload (or its preprocessed version) to S3 under ai-chats/
         logger.info(f"Uploading to S3 bucket: {S3_BUCKET_NAME}")
         try:
-            s3_client.put_object(
-                Bucket=S3_BUCKET_NAME,
-                Key=unique_filename,
-                Body=file_contents,
-                ContentType=content_type
-            )
-            
-            # Generate the URL
-            region = S3_REGION.strip('%')  # Remove any trailing % character
-            image_url = f"https://{S3_BUCKET_NAME}.s3.{region}.amazonaws.com/{unique_filename}"
+            unique_filename, file_size = await store_image(file, "ai-chats")
+            image_url = s3_object_url(unique_filename)
             
             # Log success
-            logger.info(f"Image uploaded successfully to S3: {image_url}")
+            logger.info(f"Image uploaded successfully to S3 ({file_size} bytes): {image_url}")
             
             return {"image_url": image_url}
             
+        except UploadTooLarge as size_error:
+            logger.error(f"Upload rejected: {str(size_error)}")
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=str(size_error)
+            )
         except Exception as s3_error:
             logger.error(f"S3 upload error: {str(s3_error)}")
             logger.exception("S3 exception details:")
@@ -592,6 +3726,8 @@ async def direct_upload(
             logger.info(f"S3 upload failed, generated dummy URL: {dummy_url}")
             return {"image_url": dummy_url}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Direct upload error: {str(e)}")
         logger.exception("Full exception details:")
@@ -3,6 +3,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatForm = document.getElementById('chat-form');
     const chatInput = document.getElementById('chat-input');
     const chatMessages = document.getElementById('chat-messages');
+    const sendBtn = document.getElementById('send-btn');
+    const stopBtn = document.getElementById('stop-btn');
     const newChatBtn = document.getElementById('new-chat-btn');
     const conversationHistory = document.getElementById('conversation-history');
     const historyPlaceholder = document.getElementById('history-placeholder');
@@ -31,9 +33,23 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // App state
     let currentConversationId = generateConversationId();
-    let conversations = loadConversations();
+    let conversations = [];
     let currentUser = null;
     let selectedImage = null;
+    // Sidebar deletes waiting to be sent to the server in one batch
+    const DELETE_BATCH_DELAY = 1000;
+    let pendingDeletes = [];
+    let deleteBatchTimer = null;
+    
+    // Last response and ETag of each sessions/history request
+    const revalidationCache = new Map();
+    // Conversation history is loaded a page at a time, newest first
+    const HISTORY_PAGE_SIZE = 30;
+    let historyObserver = null;
+    // The reply being generated, so the stop button can cancel it
+    let activeGeneration = null;
+    const chatSocket = createChatSocket();
+    const conversationStore = createConversationStore();
     
     // Check for just_logged_out parameter in URL
     const urlParams = new URLSearchParams(window.location.search);
@@ -134,7 +150,6 @@ document.addEventListener('DOMContentLoaded', () => {
     function validateSendButton() {
         const message = chatInput.value.trim();
         const hasImage = selectedImage !== null;
-        const sendBtn = document.getElementById('send-btn');
         
         // Disable send button if no message (even if image is selected)
         if (!message) {
@@ -159,6 +174,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         const message = chatInput.value.trim();
         if (!message) return; // Ensure there's always a text message
+        if (activeGeneration) return; // One reply at a time; the stop button cancels it
         
         // Clear input field and reset height
         chatInput.value = '';
@@ -175,6 +191,8 @@ document.addEventListener('DOMContentLoaded', () => {
         
         // Show loading indicator
         const loadingIndicator = addLoadingIndicator();
+        let streamingContent = null;
+        let streamedText = '';
         
         try {
             // Create FormData for the message and image (if any)
@@ -193,10 +211,6 @@ document.addEventListener('DOMContentLoaded', () => {
             // If image is selected, upload it first to S3
             if (selectedImage) {
                 try {
-                    // Create FormData
-                    const formData = new FormData();
-                    formData.append('image', selectedImage);
-                    
                     console.log('Uploading image...');
                     
                     // Show loading indicator on the preview
@@ -217,23 +231,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     imagePreviewElement.style.position = 'relative';
                     imagePreviewElement.appendChild(loadingOverlay);
                     
-                    // Use the direct upload endpoint which now handles S3 uploads
-                    const uploadResponse = await fetch('/api/v1/direct-upload', {
-                        method: 'POST',
-                        body: formData
-                    });
-                    
-                    console.log('Upload status:', uploadResponse.status);
-let imageUrl = null;
-
-if (uploadResponse.ok) {
-                        const uploadResult = await uploadResponse.json();
-                        console.log('Upload success:', uploadResult);
-                        imageUrl = uploadResult.image_url;
-                    } else {
-                        console.error('Direct upload failed');
-                        throw new Error(`Upload failed with status: ${uploadResponse.status}`);
-                    }
+                    imageUrl = await uploadImage(selectedImage);
                     
                     // Remove loading overlay
                     imagePreviewElement.removeChild(loadingOverlay);
@@ -304,14 +302,26 @@ if (uploadResponse.ok) {
                 }
             }
             
-            // Send message to API
-            const response = await sendMessage(requestBody);
+            // Send message to API, rendering streamed text as it arrives
+            const controller = new AbortController();
+            requestBody.request_id = generateConversationId();
+            setActiveGeneration({ requestId: requestBody.request_id, controller });
+            const response = await sendMessage(requestBody, (text) => {
+                streamedText = text;
+                if (!streamingContent) {
+                    loadingIndicator.remove();
+                    streamingContent = addStreamingMessage();
+                }
+                streamingContent.textContent = text;
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }, controller.signal);
             
             // Log the complete response for debugging
             console.log('Full API response:', JSON.stringify(response));
             
-            // Remove loading indicator
+            // Remove loading indicator and the live streaming preview
             loadingIndicator.remove();
+            removeStreamingMessage(streamingContent);
             
             // First check if the response has a direct image_content field
             if (response.type === 'image' || 
@@ -369,7 +379,7 @@ if (uploadResponse.ok) {
             }
             
             // Update conversation history
-            updateConversationHistory(message, currentConversationId);
+            updateConversationHistory(message, currentConversationId, response.text_content || '');
             
             // Clear the image preview
             imagePreview.src = '';
@@ -380,12 +390,23 @@ if (uploadResponse.ok) {
         } catch (error) {
             // Remove loading indicator
             loadingIndicator.remove();
+            removeStreamingMessage(streamingContent);
             
             // Add appropriate error message
-            if (error.message && error.message.includes('timeout')) {
+            if (error.name === 'AbortError') {
+                // Stopped by the user: keep whatever had already streamed in
+                if (streamedText) {
+                    addMessage('assistant', streamedText);
+                }
+                updateConversationHistory(message, currentConversationId, streamedText);
+            } else if (error.message && error.message.includes('timeout')) {
                 addMessage('assistant', 'The request timed out after 90 seconds. The request may be too complex or the server might be experiencing high load. Please try again with a simpler prompt.');
             } else if (error.response && error.response.status === 504) {
                 addMessage('assistant', 'The request timed out after 90 seconds. The request may be too complex or the server might be experiencing high load. Please try again with a simpler prompt.');
+            } else if (error.response && (error.response.status === 429 || error.response.status === 503)) {
+                const retryAfter = error.response.headers.get('Retry-After');
+                const detail = (error.responseData && error.responseData.error) || 'The server is busy.';
+                addMessage('assistant', `${detail}${retryAfter ? ` Please try again in ${retryAfter} seconds.` : ''}`);
             } else {
                 addMessage('assistant', 'Sorry, an error occurred. Please try again.');
             }
@@ -396,9 +417,37 @@ if (uploadResponse.ok) {
             imagePreviewContainer.classList.add('hidden');
             imageUploadInput.value = '';
             selectedImage = null;
+        } finally {
+            setActiveGeneration(null);
         }
     });
     
+    // Swap the send button for a stop button while a reply is being generated
+    function setActiveGeneration(generation) {
+        activeGeneration = generation;
+        sendBtn.classList.toggle('hidden', generation !== null);
+        stopBtn.classList.toggle('hidden', generation === null);
+    }
+    
+    // Stop the reply being generated
+    function stopGeneration() {
+        if (!activeGeneration) return;
+        const { requestId, controller } = activeGeneration;
+        // Dropping the connection cancels the backend call too; the stop request also
+        // covers proxies that keep the upstream request open after the browser leaves
+        fetch('/api/v1/chat/stop', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ request_id: requestId }),
+            keepalive: true
+        }).catch(error => console.error('Error stopping generation:', error));
+        controller.abort();
+    }
+    
+    stopBtn.addEventListener('click', stopGeneration);
+    
     // Handle new chat button click
     newChatBtn.addEventListener('click', () => {
         // Check if user is logged in
@@ -462,10 +511,11 @@ if (uploadResponse.ok) {
     logoutBtn.addEventListener('click', () => {
         // Clean up local storage before redirecting
         localStorage.removeItem('chatUser');
-        localStorage.removeItem('chatConversations');
         
-        // Redirect to server-side logout
-        window.location.href = '/logout';
+        // Drop the cached conversations, then redirect to server-side logout
+        conversationStore.clear().finally(() => {
+            window.location.href = '/logout';
+        });
     });
     
     // Handle clear conversations button click
@@ -499,11 +549,17 @@ if (uploadResponse.ok) {
         // If user just logged out, ensure all login-required elements are reset
         if (justLoggedOut) {
             currentUser = null;
+            conversationStore.clear();
             showLoginForm();
             return;
         }
         
         // Check if user data was passed from the server
+        if (typeof serverUser !== 'undefined' && serverUser && serverUser.pending) {
+            // The server only knew the email, fetch the full profile
+            loadPendingUser();
+            return;
+        }
         if (typeof serverUser !== 'undefined' && serverUser) {
             currentUser = {
                 email: serverUser.email,
@@ -531,6 +587,25 @@ if (uploadResponse.ok) {
         }
     }
     
+    // Load the signed-in user's profile when the page was served before it was cached
+    async function loadPendingUser() {
+        try {
+            const response = await fetch('/api/v1/user');
+            if (!response.ok) {
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            currentUser = await response.json();
+            showUserInfo();
+            loadUserSessions();
+            enableChatInput();
+        } catch (error) {
+            console.error('Error loading user info:', error);
+            currentUser = null;
+            localStorage.removeItem('chatUser');
+            showLoginForm();
+        }
+    }
+    
     // Enable chat input
     function enableChatInput() {
         chatInput.disabled = false;
@@ -545,6 +620,7 @@ if (uploadResponse.ok) {
     
     // Show user info
     function showUserInfo() {
+        chatSocket.connect();
         loginArea.classList.add('hidden');
         userInfo.classList.remove('hidden');
         userEmail.textContent = currentUser.email;
@@ -566,6 +642,8 @@ if (uploadResponse.ok) {
     
     // Show login form
     function showLoginForm() {
+        chatSocket.close();
+        
         // Reset user UI elements
         userInfo.classList.add('hidden');
         loginArea.classList.remove('hidden');
@@ -591,50 +669,67 @@ if (uploadResponse.ok) {
         });
     }
     
-    // Load user sessions from server
+    // POST a read request, reusing the last response when the server answers 304 Not Modified
+    async function fetchRevalidated(url, payload) {
+        const body = JSON.stringify(payload);
+        const cacheKey = `${url} ${body}`;
+        const cached = revalidationCache.get(cacheKey);
+        
+        const headers = { 'Content-Type': 'application/json' };
+        if (cached) {
+            headers['If-None-Match'] = cached.etag;
+        }
+        
+        const response = await fetch(url, { method: 'POST', headers, body });
+        
+        if (response.status === 304 && cached) {
+            return cached.data;
+        }
+        if (!response.ok) {
+            const error = new Error(`HTTP error! status: ${response.status}`);
+            error.response = response;
+            throw error;
+        }
+        
+        const data = await response.json();
+        const etag = response.headers.get('ETag');
+        if (etag) {
+            revalidationCache.set(cacheKey, { etag, data });
+        }
+        return data;
+    }
+    
+    // Load user sessions, showing the cached list first and then syncing it with the server
     async function loadUserSessions() {
         if (!currentUser) return;
+        const email = currentUser.email;
+        
+        const cached = await conversationStore.listConversations(email);
+        if (cached.length > 0 && currentUser && currentUser.email === email) {
+            conversations = cached;
+            updateConversationHistoryUI();
+        }
         
         try {
-            const response = await fetch('/api/v1/sessions', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    email_id: currentUser.email
-                })
+            const data = await fetchRevalidated('/api/v1/sessions', {
+                email_id: email
             });
-            
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            
-            const data = await response.json();
             console.log('User sessions:', data);
+            if (!currentUser || currentUser.email !== email) return;
             
-            if (data.sessions && data.sessions.length > 0) {
-                // Convert server sessions to local format
-                conversations = data.sessions.map(session => ({
-                    id: session.session_id,
-                    title: session.last_message || `Conversation ${new Date(session.created_at * 1000).toLocaleString()}`,
-                    lastUpdated: session.updated_at * 1000,
-                    email: session.email_id,
-                    messages: []
-                }));
-                
-                // Save to local storage
-                saveConversations();
-                
+            // Merge into the cache; only conversations the server changed need their messages refetched
+            conversations = await conversationStore.syncSessions(email, data.sessions || []);
+            const changed = conversations.filter(conv => conv.syncedAt !== conv.serverUpdatedAt).length;
+            console.log(`Conversations changed since last sync: ${changed} of ${conversations.length}`);
+            
+            if (conversations.length > 0) {
                 // Update UI
                 updateConversationHistoryUI();
                 
                 // Set current conversation to the most recent one
-                if (conversations.length > 0) {
-                    currentConversationId = conversations[0].id;
-                    updateActiveConversation(currentConversationId);
-                    loadConversationHistory(currentConversationId);
-                }
+                currentConversationId = conversations[0].id;
+                updateActiveConversation(currentConversationId);
+                loadConversationMessages(currentConversationId);
                 
                 // Hide placeholder
                 historyPlaceholder.classList.add('hidden');
@@ -642,8 +737,6 @@ if (uploadResponse.ok) {
                 // No sessions found
                 historyPlaceholder.textContent = 'No conversation history found. Start a new chat!';
                 historyPlaceholder.classList.remove('hidden');
-                conversations = [];
-                saveConversations();
                 updateConversationHistoryUI();
             }
             
@@ -653,42 +746,44 @@ if (uploadResponse.ok) {
         }
     }
     
-    // Load conversation history from server
+    // Load the latest page of a conversation from the server and cache it
     async function loadConversationHistory(sessionId) {
         if (!currentUser) return;
         
         try {
-            const response = await fetch('/api/v1/conversation-history', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    session_id: sessionId,
-                    email_id: currentUser.email
-                })
+            // Only the latest page is loaded up front; older messages load on scroll
+            const data = await fetchRevalidated('/api/v1/conversation-history', {
+                session_id: sessionId,
+                email_id: currentUser.email,
+                limit: HISTORY_PAGE_SIZE
             });
+            console.log('Conversation history:', data);
             
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+            const messages = data.messages || [];
+            const conversation = conversations.find(conv => conv.id === sessionId);
+            const synced = {
+                syncedAt: conversation ? conversation.serverUpdatedAt : undefined,
+                hasOlder: Boolean(data.has_more),
+                olderCursor: data.next_cursor || null
+            };
+            if (conversation) {
+                Object.assign(conversation, synced);
             }
+            await conversationStore.replaceMessages(sessionId, messages, synced);
             
-            const data = await response.json();
-            console.log('Conversation history:', data);
+            // Ignore the response if the user has switched to another conversation meanwhile
+            if (sessionId !== currentConversationId) return;
             
-            if (data.messages && data.messages.length > 0) {
+            if (messages.length > 0) {
                 // Clear chat messages
                 clearChatMessages(false); // Don't show welcome message
                 
-                // Add messages to chat
-                data.messages.forEach(message => {
-                    addMessage(
-                        message.role, 
-                        message.content, 
-                        null, // No metadata in the history
-                        null  // No image URL in the history
-                    );
-                });
+                // Add messages to chat in a single DOM update
+                chatMessages.appendChild(createHistoryFragment(messages));
+                if (data.has_more) {
+                    addLoadOlderSentinel(sessionId, olderMessages(sessionId, 0, synced.olderCursor, true));
+                }
+                chatMessages.scrollTop = chatMessages.scrollHeight;
             } else {
                 // No messages found
                 clearChatMessages(); // Show welcome message
@@ -701,49 +796,176 @@ if (uploadResponse.ok) {
         }
     }
     
+    // Page through a conversation's older messages: cached ones first, then the server from cursor
+    function olderMessages(sessionId, firstOrder, cursor, hasOlder) {
+        return async () => {
+            const cached = await conversationStore.messagesBefore(sessionId, firstOrder, HISTORY_PAGE_SIZE);
+            if (cached.length > 0) {
+                firstOrder = cached[0].order;
+                return { messages: cached, hasMore: cached.length === HISTORY_PAGE_SIZE || hasOlder };
+            }
+            if (!hasOlder) {
+                return { messages: [], hasMore: false };
+            }
+            
+            const data = await fetchRevalidated('/api/v1/conversation-history', {
+                session_id: sessionId,
+                email_id: currentUser.email,
+                limit: HISTORY_PAGE_SIZE,
+                before: cursor
+            });
+            const messages = data.messages || [];
+            cursor = data.next_cursor || null;
+            hasOlder = Boolean(data.has_more);
+            const stored = await conversationStore.prependMessages(sessionId, messages, {
+                hasOlder,
+                olderCursor: cursor
+            });
+            if (stored !== null) {
+                firstOrder = stored;
+            }
+            return { messages, hasMore: hasOlder };
+        };
+    }
+    
+    // Add a marker above the oldest message that loads the previous page when scrolled into view
+    function addLoadOlderSentinel(sessionId, loadOlder) {
+        const sentinel = document.createElement('div');
+        sentinel.classList.add('load-older');
+        sentinel.textContent = 'Loading older messages...';
+        chatMessages.insertBefore(sentinel, chatMessages.firstChild);
+        
+        let loading = false;
+        historyObserver = new IntersectionObserver(async (entries) => {
+            if (loading || !entries.some(entry => entry.isIntersecting)) return;
+            loading = true;
+            
+            try {
+                const page = await loadOlder();
+                if (sessionId !== currentConversationId || !sentinel.isConnected) return;
+                
+                // Prepend while keeping the visible messages where they are
+                const previousHeight = chatMessages.scrollHeight;
+                sentinel.after(createHistoryFragment(page.messages));
+                chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+                
+                if (page.hasMore) {
+                    // Re-observe so a sentinel that is still visible triggers the next page
+                    historyObserver.unobserve(sentinel);
+                    historyObserver.observe(sentinel);
+                } else {
+                    disconnectHistoryObserver();
+                    sentinel.remove();
+                }
+            } catch (error) {
+                if (error.response && error.response.status === 409 && sessionId === currentConversationId) {
+                    // The cursor has expired on the server: reload the conversation from its newest page
+                    loadConversationHistory(sessionId);
+                    return;
+                }
+                console.error('Error loading older messages:', error);
+                sentinel.textContent = 'Failed to load older messages.';
+                disconnectHistoryObserver();
+            } finally {
+                loading = false;
+            }
+        }, { root: chatMessages, rootMargin: '200px 0px 0px 0px' });
+        historyObserver.observe(sentinel);
+    }
+    
+    // Stop watching for scrolls to the top of the current conversation
+    function disconnectHistoryObserver() {
+        if (historyObserver) {
+            historyObserver.disconnect();
+            historyObserver = null;
+        }
+    }
+    
     // Delete a conversation
     async function deleteConversation(conversationId) {
         if (!confirm('Are you sure you want to delete this conversation?')) return;
         
+        // Remove from local conversations right away; the server delete is batched
+        conversations = conversations.filter(conv => conv.id !== conversationId);
+        conversationStore.deleteConversation(conversationId);
+        
+        // Update UI
+        updateConversationHistoryUI();
+        
+        // If the deleted conversation was the current one, create a new chat
+        if (conversationId === currentConversationId) {
+            newChatBtn.click();
+        }
+        
+        if (!currentUser) return;
+        
         try {
-            if (currentUser) {
-                // Delete from server
-                const response = await fetch('/api/v1/clear-conversation', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        conversation_id: conversationId,
-                        email_id: currentUser.email
-                    })
-                });
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
-                }
-                
-                console.log('Conversation deleted from server');
-            }
-            
-            // Remove from local conversations
-            conversations = conversations.filter(conv => conv.id !== conversationId);
-            saveConversations();
-            
-            // Update UI
-            updateConversationHistoryUI();
+            await queueConversationDelete(conversationId);
+            console.log('Conversation deleted from server');
+        } catch (error) {
+            console.error('Error deleting conversation:', error);
+            alert('Failed to delete conversation. Please try again later.');
+            // Bring back whatever the server still has
+            loadUserSessions();
+        }
+    }
+    
+    // Queue a server-side delete; deletes made in quick succession are sent as one batch request
+    function queueConversationDelete(conversationId) {
+        return new Promise((resolve, reject) => {
+            pendingDeletes.push({ conversationId, resolve, reject });
+            clearTimeout(deleteBatchTimer);
+            deleteBatchTimer = setTimeout(flushConversationDeletes, DELETE_BATCH_DELAY);
+        });
+    }
+    
+    async function flushConversationDeletes(keepalive = false) {
+        const batch = pendingDeletes;
+        pendingDeletes = [];
+        clearTimeout(deleteBatchTimer);
+        deleteBatchTimer = null;
+        if (batch.length === 0) return;
+        
+        try {
+            const response = await fetch('/api/v1/clear-conversation/batch', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    conversation_ids: batch.map(item => item.conversationId),
+                    email_id: currentUser.email
+                }),
+                // Lets the request finish if the page is being closed
+                keepalive
+            });
             
-            // If the deleted conversation was the current one, create a new chat
-            if (conversationId === currentConversationId) {
-                newChatBtn.click();
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
             }
             
+            const data = await response.json();
+            const results = new Map(data.results.map(result => [result.conversation_id, result]));
+            batch.forEach(item => {
+                const result = results.get(item.conversationId);
+                if (result && result.status === 'ok') {
+                    item.resolve();
+                } else {
+                    item.reject(new Error((result && result.error) || 'Delete failed'));
+                }
+            });
         } catch (error) {
-            console.error('Error deleting conversation:', error);
-            alert('Failed to delete conversation. Please try again later.');
+            batch.forEach(item => item.reject(error));
         }
     }
     
+    // Don't lose deletes that are still waiting for their batch
+    window.addEventListener('pagehide', () => {
+        if (pendingDeletes.length > 0) {
+            flushConversationDeletes(true);
+        }
+    });
+    
     // Clear all conversations
     async function clearAllConversations() {
         try {
@@ -768,7 +990,7 @@ if (uploadResponse.ok) {
             
             // Clear local conversations
             conversations = [];
-            saveConversations();
+            conversationStore.clear();
             
             // Update UI
             updateConversationHistoryUI();
@@ -792,14 +1014,238 @@ if (uploadResponse.ok) {
         clearModal.classList.remove('show');
     }
     
+    // Function to upload an image, straight to S3 when presigned uploads are available
+    async function uploadImage(file) {
+        const uploadUrlResponse = await fetch('/api/v1/upload-url', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                filename: file.name,
+                content_type: file.type,
+                size: file.size
+            })
+        });
+        
+        if (uploadUrlResponse.ok) {
+            const presigned = await uploadUrlResponse.json();
+            
+            const formData = new FormData();
+            Object.entries(presigned.fields).forEach(([name, value]) => {
+                formData.append(name, value);
+            });
+            // S3 requires the file to be the last field
+            formData.append('file', file);
+            
+            const s3Response = await fetch(presigned.url, {
+                method: 'POST',
+                body: formData
+            });
+            if (!s3Response.ok) {
+                throw new Error(`Upload failed with status: ${s3Response.status}`);
+            }
+            
+            const confirmResponse = await fetch('/api/v1/upload-complete', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ key: presigned.key })
+            });
+            if (!confirmResponse.ok) {
+                throw new Error(`Upload confirmation failed with status: ${confirmResponse.status}`);
+            }
+            
+            const confirmResult = await confirmResponse.json();
+            console.log('Upload success:', confirmResult);
+            return confirmResult.image_url;
+        }
+        
+        if (uploadUrlResponse.status !== 503) {
+            throw new Error(`Upload failed with status: ${uploadUrlResponse.status}`);
+        }
+        
+        // Presigned uploads unavailable, send the file through the server instead
+        const formData = new FormData();
+        formData.append('image', file);
+        
+        const uploadResponse = await fetch('/api/v1/direct-upload', {
+            method: 'POST',
+            body: formData
+        });
+        
+        console.log('Upload status:', uploadResponse.status);
+        
+        if (!uploadResponse.ok) {
+            console.error('Direct upload failed');
+            throw new Error(`Upload failed with status: ${uploadResponse.status}`);
+        }
+        
+        const uploadResult = await uploadResponse.json();
+        console.log('Upload success:', uploadResult);
+        return uploadResult.image_url;
+    }
+    
+    // Chat over one WebSocket, authenticated once, with replies matched to requests by id.
+    // sendMessage falls back to HTTP whenever the socket isn't open
+    function createChatSocket() {
+        const RECONNECT_MAX_DELAY = 30000;
+        const pending = new Map();
+        let socket = null;
+        let enabled = false;
+        let heartbeat = 25;
+        let resumeTimeout = 30;
+        let heartbeatTimer = null;
+        let reconnectTimer = null;
+        let reconnectDelay = 1000;
+        let lastFrameAt = 0;
+        
+        function connect() {
+            if (!('WebSocket' in window)) return;
+            enabled = true;
+            if (socket) return;
+            const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+            socket = new WebSocket(`${protocol}//${window.location.host}/api/v1/chat/ws`);
+            socket.addEventListener('message', (event) => handleFrame(JSON.parse(event.data)));
+            socket.addEventListener('close', handleClose);
+        }
+        
+        function close() {
+            enabled = false;
+            clearTimeout(reconnectTimer);
+            if (socket) socket.close(1000);
+        }
+        
+        function isOpen() {
+            return socket !== null && socket.readyState === WebSocket.OPEN && lastFrameAt > 0;
+        }
+        
+        function send(frame) {
+            socket.send(JSON.stringify(frame));
+        }
+        
+        function handleFrame(frame) {
+            lastFrameAt = Date.now();
+            if (frame.type === 'ready') {
+                heartbeat = frame.heartbeat;
+                resumeTimeout = frame.resume_timeout;
+                reconnectDelay = 1000;
+                startHeartbeat();
+                // Pick up replies that were still streaming when the last connection dropped
+                pending.forEach((request, id) => {
+                    clearTimeout(request.resumeTimer);
+                    send({ type: 'resume', id, after: request.lastSeq });
+                });
+                return;
+            }
+            
+            const request = pending.get(frame.id);
+            if (!request) return;
+            // Frames replayed after a resume may already have been seen
+            if (frame.seq !== undefined) {
+                if (frame.seq <= request.lastSeq) return;
+                request.lastSeq = frame.seq;
+            }
+            
+            if (frame.type === 'delta') {
+                request.text += frame.delta;
+                if (request.onDelta) request.onDelta(request.text);
+            } else if (frame.type === 'done') {
+                const response = frame.response;
+                if (response.text_content === undefined) {
+                    response.text_content = request.text;
+                }
+                finish(frame.id).resolve(response);
+            } else if (frame.type === 'stopped') {
+                finish(frame.id).reject(new DOMException('Generation stopped', 'AbortError'));
+            } else if (frame.type === 'error') {
+                // Shaped like a failed fetch, so callers handle both transports the same way
+                const error = new Error(`HTTP error! status: ${frame.status}`);
+                error.response = {
+                    status: frame.status,
+                    headers: new Headers(frame.retry_after ? { 'Retry-After': String(frame.retry_after) } : {})
+                };
+                error.responseData = { error: frame.error };
+                finish(frame.id).reject(error);
+            }
+        }
+        
+        function finish(id) {
+            const request = pending.get(id);
+            pending.delete(id);
+            clearTimeout(request.resumeTimer);
+            if (request.signal) request.signal.removeEventListener('abort', request.onAbort);
+            return request;
+        }
+        
+        function handleClose(event) {
+            socket = null;
+            lastFrameAt = 0;
+            clearInterval(heartbeatTimer);
+            // Replies keep running on the server for a while; give up on them if we can't get back in time
+            pending.forEach((request, id) => {
+                clearTimeout(request.resumeTimer);
+                request.resumeTimer = setTimeout(() => {
+                    if (pending.has(id)) {
+                        finish(id).reject(new Error('Connection lost'));
+                    }
+                }, resumeTimeout * 1000);
+            });
+            // 4401: not signed in, or the session expired; HTTP requests will show the login form
+            if (!enabled || event.code === 4401) return;
+            reconnectTimer = setTimeout(connect, reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_DELAY);
+        }
+        
+        function startHeartbeat() {
+            clearInterval(heartbeatTimer);
+            heartbeatTimer = setInterval(() => {
+                if (!isOpen()) return;
+                // No frame, not even a pong, for two heartbeats: the connection is dead even if the browser hasn't noticed
+                if (Date.now() - lastFrameAt > heartbeat * 2000) {
+                    socket.close();
+                    return;
+                }
+                send({ type: 'ping' });
+            }, heartbeat * 1000);
+        }
+        
+        // Resolves with the final response, like the HTTP path; onDelta receives the text so far
+        function chat(requestBody, onDelta, signal) {
+            return new Promise((resolve, reject) => {
+                const id = requestBody.request_id || generateConversationId();
+                const request = { resolve, reject, onDelta, signal, text: '', lastSeq: 0, resumeTimer: null };
+                request.onAbort = () => {
+                    if (isOpen()) send({ type: 'stop', id });
+                    finish(id).reject(new DOMException('Generation stopped', 'AbortError'));
+                };
+                if (signal) signal.addEventListener('abort', request.onAbort);
+                pending.set(id, request);
+                const { request_id, ...fields } = requestBody;
+                send({ ...fields, type: 'chat', id });
+            });
+        }
+        
+        return { connect, close, isOpen, chat };
+    }
+    
     // Function to send message to API
-    async function sendMessage(requestBody) {
+    // Asks for a streamed reply; onDelta receives the text accumulated so far
+    // Aborting signal cancels the request, and the server cancels the backend call with it
+    async function sendMessage(requestBody, onDelta = null, signal = null) {
+        if (chatSocket.isOpen()) {
+            return await chatSocket.chat(requestBody, onDelta, signal);
+        }
+        
         const response = await fetch('/api/v1/chat', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream, application/json'
             },
-            body: JSON.stringify(requestBody)
+            body: JSON.stringify(requestBody),
+            signal
         });
         
         if (!response.ok) {
@@ -810,11 +1256,90 @@ if (uploadResponse.ok) {
             throw error;
         }
         
+        // The server falls back to plain JSON when the backend doesn't stream
+        const contentType = response.headers.get('Content-Type') || '';
+        if (contentType.includes('text/event-stream') && response.body) {
+            return await readChatStream(response, onDelta);
+        }
+        
         return await response.json();
     }
     
+    // Function to read a Server-Sent Events chat stream into a final response
+    async function readChatStream(response, onDelta) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let finalResponse = null;
+        
+        const handleEvent = (rawEvent) => {
+            let eventName = 'message';
+            const dataLines = [];
+            rawEvent.split(/\r?\n/).forEach(line => {
+                if (line.startsWith('event:')) {
+                    eventName = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).replace(/^ /, ''));
+                }
+            });
+            const data = dataLines.join('\n');
+            if (!data || data === '[DONE]') return;
+            
+            let payload;
+            try {
+                payload = JSON.parse(data);
+            } catch (e) {
+                payload = { delta: data };
+            }
+            
+            if (eventName === 'error' || payload.error) {
+                throw new Error(payload.error || 'Stream error');
+            }
+            
+            // Incremental chunks carry "delta"; a complete response object ends the stream
+            const delta = payload.delta !== undefined ? payload.delta : payload.token;
+            if (typeof delta === 'string') {
+                text += delta;
+                if (onDelta) onDelta(text);
+            } else if (payload.type || payload.text_content !== undefined) {
+                finalResponse = payload;
+            }
+        };
+        
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split(/\r?\n\r?\n/);
+            buffer = events.pop();
+            events.forEach(handleEvent);
+        }
+        if (buffer.trim()) handleEvent(buffer);
+        
+        if (!finalResponse) {
+            return { type: 'text', text_content: text, metadata: null };
+        }
+        if (finalResponse.text_content === undefined) {
+            finalResponse.text_content = text;
+        }
+        return finalResponse;
+    }
+    
     // Function to add a message to the chat
     function addMessage(sender, content, metadata = null, imageUrl = null) {
+        chatMessages.appendChild(createMessageElement(sender, content, metadata, imageUrl));
+        
+        // Scroll to bottom with smooth animation
+        chatMessages.scrollTo({
+            top: chatMessages.scrollHeight,
+            behavior: 'smooth'
+        });
+    }
+    
+    // Function to build the element for a chat message
+    function createMessageElement(sender, content, metadata = null, imageUrl = null) {
         console.log('Adding message with content:', content);
         console.log('Image URL:', imageUrl);
         
@@ -991,13 +1516,21 @@ if (uploadResponse.ok) {
             messageDiv.appendChild(metadataDiv);
         }
         
-        chatMessages.appendChild(messageDiv);
-        
-        // Scroll to bottom with smooth animation
-        chatMessages.scrollTo({
-            top: chatMessages.scrollHeight,
-            behavior: 'smooth'
+        return messageDiv;
+    }
+    
+    // Function to build the elements for a page of history messages in one fragment
+    function createHistoryFragment(messages) {
+        const fragment = document.createDocumentFragment();
+        messages.forEach(message => {
+            fragment.appendChild(createMessageElement(
+                message.role,
+                message.content,
+                null, // No metadata in the history
+                null  // No image URL in the history
+            ));
         });
+        return fragment;
     }
     
     // Function to add loading indicator
@@ -1016,8 +1549,29 @@ if (uploadResponse.ok) {
         return loadingDiv;
     }
     
+    // Function to add an assistant message that is filled in while a reply streams
+    function addStreamingMessage() {
+        const messageDiv = document.createElement('div');
+        messageDiv.classList.add('chat-message', 'assistant-message', 'streaming-message');
+        
+        const messageContent = document.createElement('div');
+        messageContent.classList.add('message-content');
+        messageDiv.appendChild(messageContent);
+        
+        chatMessages.appendChild(messageDiv);
+        return messageContent;
+    }
+    
+    // Function to remove the streaming preview once the final message is rendered
+    function removeStreamingMessage(streamingContent) {
+        if (streamingContent && streamingContent.parentElement) {
+            streamingContent.parentElement.remove();
+        }
+    }
+    
     // Function to clear chat messages
     function clearChatMessages(showWelcome = true) {
+        disconnectHistoryObserver();
         if (showWelcome) {
             chatMessages.innerHTML = `
                 <div class="welcome-message">
@@ -1035,8 +1589,8 @@ if (uploadResponse.ok) {
         return Date.now().toString(36) + Math.random().toString(36).substr(2);
     }
     
-    // Function to update conversation history
-    function updateConversationHistory(message, conversationId) {
+    // Function to update conversation history, caching the turn when there is a reply
+    function updateConversationHistory(message, conversationId, reply) {
         // Check if conversation already exists
         const existingConversation = conversations.find(conv => conv.id === conversationId);
         
@@ -1053,15 +1607,20 @@ if (uploadResponse.ok) {
                 id: conversationId,
                 title: message.substring(0, 30) + (message.length > 30 ? '...' : ''),
                 lastUpdated: Date.now(),
-                email: currentUser ? currentUser.email : null,
-                messages: []
+                email: currentUser ? currentUser.email : null
             };
             
             conversations.unshift(newConversation);
         }
         
-        // Save conversations to local storage
-        saveConversations();
+        // Write just this conversation and turn to the local cache
+        conversationStore.putConversation(existingConversation || conversations[0]);
+        if (reply !== undefined) {
+            conversationStore.appendMessages(conversationId, [
+                { role: 'user', content: message },
+                { role: 'assistant', content: reply }
+            ]);
+        }
         
         // Update UI
         updateConversationHistoryUI();
@@ -1129,25 +1688,28 @@ if (uploadResponse.ok) {
         }
     }
     
-    // Function to load conversation messages
-    function loadConversationMessages(conversationId) {
+    // Function to load conversation messages, from the local cache while it is up to date
+    async function loadConversationMessages(conversationId) {
         // Clear chat messages
         clearChatMessages();
         
-        // Find conversation
+        // Conversations the last sessions sync found unchanged are read from the cache
         const conversation = conversations.find(conv => conv.id === conversationId);
-        
-        if (conversation && conversation.messages && conversation.messages.length > 0) {
-            // Remove welcome message
-            const welcomeMessage = document.querySelector('.welcome-message');
-            if (welcomeMessage) {
-                welcomeMessage.remove();
-            }
+        if (conversation && conversation.syncedAt === conversation.serverUpdatedAt) {
+            const messages = await conversationStore.latestMessages(conversationId, HISTORY_PAGE_SIZE);
+            if (conversationId !== currentConversationId) return;
             
-            // Add messages to chat
-            conversation.messages.forEach(message => {
-                addMessage(message.sender, message.content, message.metadata, message.imageUrl);
-            });
+            if (messages.length > 0) {
+                clearChatMessages(false); // Don't show welcome message
+                chatMessages.appendChild(createHistoryFragment(messages));
+                if (messages.length === HISTORY_PAGE_SIZE || conversation.hasOlder) {
+                    addLoadOlderSentinel(conversationId, olderMessages(
+                        conversationId, messages[0].order, conversation.olderCursor, Boolean(conversation.hasOlder)
+                    ));
+                }
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+                return;
+            }
         }
         
         // If user is logged in, try to load from server
@@ -1156,14 +1718,230 @@ if (uploadResponse.ok) {
         }
     }
     
-    // Function to load conversations from local storage
-    function loadConversations() {
-        const savedConversations = localStorage.getItem('chatConversations');
-        return savedConversations ? JSON.parse(savedConversations) : [];
-    }
-    
-    // Function to save conversations to local storage
-    function saveConversations() {
-        localStorage.setItem('chatConversations', JSON.stringify(conversations));
+    // Conversations and their messages in IndexedDB, one record per conversation and per message,
+    // so a new turn writes a few small records instead of re-serialising everything. Messages are
+    // keyed by [conversationId, order], oldest first, so a page of a conversation is one range scan.
+    // Without IndexedDB (e.g. some private windows) every call is a no-op and history comes from the server
+    function createConversationStore() {
+        const DB_NAME = 'chatgpt-clone';
+        const DB_VERSION = 1;
+        let dbPromise = null;
+        
+        function open() {
+            if (!dbPromise) {
+                dbPromise = new Promise(resolve => {
+                    if (!('indexedDB' in window)) {
+                        resolve(null);
+                        return;
+                    }
+                    const request = indexedDB.open(DB_NAME, DB_VERSION);
+                    request.onupgradeneeded = () => {
+                        const db = request.result;
+                        db.createObjectStore('conversations', { keyPath: 'id' }).createIndex('email', 'email');
+                        db.createObjectStore('messages', { keyPath: ['conversationId', 'order'] });
+                    };
+                    request.onsuccess = () => resolve(request.result);
+                    request.onerror = () => {
+                        console.warn('IndexedDB unavailable, conversations will not be cached:', request.error);
+                        resolve(null);
+                    };
+                }).then(migrateLocalStorage);
+            }
+            return dbPromise;
+        }
+        
+        // Conversations used to be one localStorage blob; move them over once
+        async function migrateLocalStorage(db) {
+            const saved = localStorage.getItem('chatConversations');
+            if (!db || !saved) return db;
+            try {
+                const tx = db.transaction('conversations', 'readwrite');
+                JSON.parse(saved).forEach(conversation => tx.objectStore('conversations').put({
+                    id: conversation.id,
+                    email: conversation.email,
+                    title: conversation.title,
+                    lastUpdated: conversation.lastUpdated
+                }));
+                await transactionDone(tx);
+                localStorage.removeItem('chatConversations');
+            } catch (error) {
+                console.error('Error migrating saved conversations:', error);
+            }
+            return db;
+        }
+        
+        function transactionDone(tx) {
+            return new Promise((resolve, reject) => {
+                tx.oncomplete = () => resolve();
+                tx.onerror = tx.onabort = () => reject(tx.error);
+            });
+        }
+        
+        // Run fn(tx) in one transaction; fn must queue its requests without awaiting anything else
+        async function withTransaction(storeNames, mode, fn, fallback = undefined) {
+            const db = await open();
+            if (!db) return fallback;
+            const tx = db.transaction(storeNames, mode);
+            const result = {};
+            fn(tx, result);
+            await transactionDone(tx);
+            return result.value;
+        }
+        
+        function messageRange(conversationId, upper = Infinity, upperOpen = false) {
+            return IDBKeyRange.bound([conversationId, -Infinity], [conversationId, upper], false, upperOpen);
+        }
+        
+        // Read up to limit messages walking backwards through range, returned oldest first
+        function readBackwards(tx, range, limit, result) {
+            const messages = [];
+            tx.objectStore('messages').openCursor(range, 'prev').onsuccess = (event) => {
+                const cursor = event.target.result;
+                if (cursor && messages.length < limit) {
+                    messages.push(cursor.value);
+                    cursor.continue();
+                } else {
+                    result.value = messages.reverse();
+                }
+            };
+        }
+        
+        // Write messages after (or before) the conversation's current ones and update its record
+        function addMessages(tx, conversationId, messages, direction, changes, result) {
+            const store = tx.objectStore('messages');
+            store.openCursor(messageRange(conversationId), direction === 'append' ? 'prev' : 'next').onsuccess = (event) => {
+                const cursor = event.target.result;
+                const edge = cursor ? cursor.value.order : 0;
+                const first = direction === 'append' ? (cursor ? edge + 1 : 0) : edge - messages.length;
+                messages.forEach((message, i) => store.put({
+                    conversationId,
+                    order: first + i,
+                    role: message.role,
+                    content: message.content
+                }));
+                result.value = first;
+            };
+            updateConversation(tx, conversationId, changes);
+        }
+        
+        function updateConversation(tx, conversationId, changes) {
+            if (!changes) return;
+            const store = tx.objectStore('conversations');
+            store.get(conversationId).onsuccess = (event) => {
+                if (event.target.result) {
+                    store.put({ ...event.target.result, ...changes });
+                }
+            };
+        }
+        
+        return {
+            open,
+            
+            listConversations(email) {
+                return withTransaction('conversations', 'readonly', (tx, result) => {
+                    tx.objectStore('conversations').index('email').getAll(email).onsuccess = (event) => {
+                        result.value = event.target.result.sort((a, b) => b.lastUpdated - a.lastUpdated);
+                    };
+                }, []);
+            },
+            
+            getConversation(conversationId) {
+                return withTransaction('conversations', 'readonly', (tx, result) => {
+                    tx.objectStore('conversations').get(conversationId).onsuccess = (event) => {
+                        result.value = event.target.result;
+                    };
+                });
+            },
+            
+            putConversation(conversation) {
+                return withTransaction('conversations', 'readwrite', (tx) => {
+                    tx.objectStore('conversations').put(conversation);
+                });
+            },
+            
+            deleteConversation(conversationId) {
+                return withTransaction(['conversations', 'messages'], 'readwrite', (tx) => {
+                    tx.objectStore('conversations').delete(conversationId);
+                    tx.objectStore('messages').delete(messageRange(conversationId));
+                });
+            },
+            
+            clear() {
+                return withTransaction(['conversations', 'messages'], 'readwrite', (tx) => {
+                    tx.objectStore('conversations').clear();
+                    tx.objectStore('messages').clear();
+                });
+            },
+            
+            // Merge the server's session list into the store. Conversations whose updated_at moved
+            // keep their messages but are no longer marked synced; ones gone from the server are dropped
+            syncSessions(email, sessions) {
+                const fromServer = sessions.map(session => ({
+                    id: session.session_id,
+                    email,
+                    title: session.last_message || `Conversation ${new Date(session.created_at * 1000).toLocaleString()}`,
+                    lastUpdated: session.updated_at * 1000,
+                    serverUpdatedAt: session.updated_at
+                }));
+                return withTransaction(['conversations', 'messages'], 'readwrite', (tx, result) => {
+                    const store = tx.objectStore('conversations');
+                    store.index('email').getAll(email).onsuccess = (event) => {
+                        const existing = new Map(event.target.result.map(conversation => [conversation.id, conversation]));
+                        const keep = new Set(fromServer.map(conversation => conversation.id));
+                        existing.forEach((conversation, id) => {
+                            if (!keep.has(id)) {
+                                store.delete(id);
+                                tx.objectStore('messages').delete(messageRange(id));
+                            }
+                        });
+                        result.value = fromServer.map(conversation => {
+                            const merged = { ...existing.get(conversation.id), ...conversation };
+                            store.put(merged);
+                            return merged;
+                        });
+                    };
+                }, fromServer);
+            },
+            
+            latestMessages(conversationId, limit) {
+                return withTransaction('messages', 'readonly', (tx, result) => {
+                    readBackwards(tx, messageRange(conversationId), limit, result);
+                }, []);
+            },
+            
+            messagesBefore(conversationId, order, limit) {
+                return withTransaction('messages', 'readonly', (tx, result) => {
+                    readBackwards(tx, messageRange(conversationId, order, true), limit, result);
+                }, []);
+            },
+            
+            // Replace a conversation's messages with the latest page from the server
+            replaceMessages(conversationId, messages, changes) {
+                return withTransaction(['conversations', 'messages'], 'readwrite', (tx) => {
+                    const store = tx.objectStore('messages');
+                    store.delete(messageRange(conversationId));
+                    messages.forEach((message, order) => store.put({
+                        conversationId,
+                        order,
+                        role: message.role,
+                        content: message.content
+                    }));
+                    updateConversation(tx, conversationId, changes);
+                });
+            },
+            
+            // Store an older page from the server in front of the others; resolves to its first order
+            prependMessages(conversationId, messages, changes) {
+                return withTransaction(['conversations', 'messages'], 'readwrite', (tx, result) => {
+                    addMessages(tx, conversationId, messages, 'prepend', changes, result);
+                }, null);
+            },
+            
+            appendMessages(conversationId, messages) {
+                return withTransaction(['conversations', 'messages'], 'readwrite', (tx, result) => {
+                    addMessages(tx, conversationId, messages, 'append', null, result);
+                });
+            }
+        };
     }
 }); 
\ No newline at end of file